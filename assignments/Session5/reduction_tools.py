@@ -2,14 +2,20 @@ from __future__ import (division, print_function, absolute_import,
                         unicode_literals)
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import os
+import queue
+import sys
+import threading
+import time
 import warnings
-import six
-
-import ccdproc
 
 import numpy as np
 
+# ccdproc, astropy and scipy are slow to import, so they are imported in the
+# functions that need them rather than here. Importing this module (e.g. in
+# every worker of a process pool) is then quick.
+
 
 DEFAULT_IMAGE_UNIT = "adu"
 
@@ -33,11 +39,236 @@ REDUCE_IMAGE_DTYPE_MAPPING = {
 # not the image should be broken up into chunks.
 DEFAULT_MEMORY_LIMIT = 4e9  # roughly 4GB
 
+# Number of frames the pipelined reduction lets the reader get ahead of the
+# calibration, and the calibration get ahead of the writer.
+DEFAULT_PIPELINE_DEPTH = 2
+
+# Tile compression available for output files. RICE quantizes floating point
+# images to a fraction of the noise (see quantize_level), GZIP is lossless.
+COMPRESSION_TYPES = {
+    'rice': 'RICE_1',
+    'gzip': 'GZIP_1'
+}
+DEFAULT_QUANTIZE_LEVEL = 16.0
+
+
+def image_hdu_index(path):
+    """
+    Index of the first HDU in a FITS file that contains an image.
+
+    Tile-compressed images are stored in an extension behind an empty primary
+    HDU, which `ccdproc.CCDData.read` does not look past by default.
+    """
+    from astropy.io import fits
+
+    with fits.open(path) as hdulist:
+        for index, hdu in enumerate(hdulist):
+            if hdu.is_image and hdu.header.get('NAXIS', 0) > 0:
+                return index
+    return 0
+
+
+def compress_hdulist(hdulist, compression, quantize_level=DEFAULT_QUANTIZE_LEVEL, ext=0):
+    """
+    Copy of ``hdulist`` with the image in extension ``ext`` tile-compressed.
+
+    The compressed image goes in the first extension. Its header keywords are
+    also copied to the (empty) primary header, so an
+    `ccdproc.ImageFileCollection` still finds the file by keyword.
+
+    Parameters
+    ----------
+    hdulist : `astropy.io.fits.HDUList`
+        Image, and any other extensions, to compress
+    compression : str
+        One of the keys of ``COMPRESSION_TYPES``
+    quantize_level : float, optional
+        Quantization of floating point data for RICE compression, as a
+        fraction of the noise in each tile. Larger values are more accurate
+        but compress less. GZIP compression is always lossless.
+    ext : int, optional
+        Index of the HDU holding the image
+    """
+    from astropy.io import fits
+
+    try:
+        compression_type = COMPRESSION_TYPES[compression.lower()]
+    except KeyError:
+        raise ValueError("Unknown compression {}, should be one of "
+                         "{}".format(compression, sorted(COMPRESSION_TYPES)))
+    if compression_type == 'GZIP_1':
+        # a quantize level of zero turns quantization off
+        quantize_level = 0.0
+    image = hdulist[ext]
+    compressed = fits.CompImageHDU(data=image.data, header=image.header,
+                                   compression_type=compression_type,
+                                   quantize_level=quantize_level)
+    others = [hdu for index, hdu in enumerate(hdulist) if index not in (0, ext)]
+    return fits.HDUList([fits.PrimaryHDU(header=image.header.copy(strip=True)),
+                         compressed] + others)
+
+
+class CompressionStats:
+    """
+    Running totals of the space saved by compressing output files, and the
+    time spent writing them and reading them back.
+    """
+    def __init__(self):
+        self.files = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.write_time = 0.0
+        self.read_time = 0.0
+
+    def add(self, raw_bytes, compressed_bytes, write_time, read_time):
+        self.files += 1
+        self.raw_bytes += raw_bytes
+        self.compressed_bytes += compressed_bytes
+        self.write_time += write_time
+        self.read_time += read_time
+
+    @property
+    def ratio(self):
+        """Size of the files uncompressed divided by their compressed size"""
+        return self.raw_bytes / self.compressed_bytes if self.compressed_bytes else 0.0
+
+    def summary(self):
+        if not self.files:
+            return "No files compressed"
+        return ("Compressed {} files by a factor of {:.2f} ({:.1f} MB to {:.1f} MB). "
+                "Writing took {:.2f} s and reading back {:.2f} s.".format(
+                    self.files, self.ratio, self.raw_bytes/1e6, self.compressed_bytes/1e6,
+                    self.write_time, self.read_time))
+
+
+def _close(entry):
+    """Close the value in a queue entry, if it is a file-like object such as an HDUList"""
+    close = getattr(entry[1], 'close', None)
+    if close is not None:
+        close()
+
+
+def _pipeline(items, read, process, write, depth=DEFAULT_PIPELINE_DEPTH):
+    """
+    Run read, process and write over a sequence of items, overlapping the stages.
+
+    ``read(item)`` runs in a background thread and feeds ``process(item, value)``,
+    which runs in the calling thread. Its results are passed to ``write(item, value)``
+    in a second background thread. The stages are linked by queues that hold at
+    most ``depth`` items, so at most a few items are in memory at once, and items
+    are written in the order they are read.
+
+    If reading or processing an item fails, everything before it is still
+    written, as it would be if the items were handled one at a time. If writing
+    fails, the other stages stop straight away. Any values left unwritten are
+    closed, and the exception is re-raised in the calling thread once the
+    stage threads have finished.
+    """
+    done = object()
+    # set if writing fails or the calling thread is interrupted
+    abort = threading.Event()
+    # set if processing fails, so nothing more needs to be read
+    stop_reading = threading.Event()
+    to_process = queue.Queue(maxsize=depth)
+    to_write = queue.Queue(maxsize=depth)
+    errors = {}
+
+    def fail(stage, item):
+        errors[stage] = (item, sys.exc_info())
+
+    def put(q, value, stop=abort):
+        # Give up if a later stage has stopped rather than blocking forever.
+        while not (stop.is_set() or abort.is_set()):
+            try:
+                q.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not abort.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return done
+
+    def reader():
+        item = None
+        try:
+            for item in items:
+                value = read(item)
+                if not put(to_process, (item, value), stop_reading):
+                    _close((item, value))
+                    return
+        except Exception:
+            fail('reading', item)
+        put(to_process, done, stop_reading)
+
+    def writer():
+        while True:
+            entry = get(to_write)
+            if entry is done:
+                return
+            item, value = entry
+            try:
+                write(item, value)
+            except Exception:
+                fail('writing', item)
+                abort.set()
+                return
+
+    threads = [threading.Thread(target=reader), threading.Thread(target=writer)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        while True:
+            entry = get(to_process)
+            if entry is done:
+                break
+            item, value = entry
+            try:
+                processed = process(item, value)
+            except Exception:
+                fail('processing', item)
+                stop_reading.set()
+                _close(entry)
+                break
+            if not put(to_write, (item, processed)):
+                _close((item, processed))
+                break
+        put(to_write, done)
+    finally:
+        if sys.exc_info()[0] is not None:
+            # e.g. KeyboardInterrupt in the calling thread
+            abort.set()
+        stop_reading.set()
+        for thread in threads:
+            thread.join()
+        for q in (to_process, to_write):
+            while not q.empty():
+                entry = q.get()
+                if entry is not done:
+                    _close(entry)
+
+    # A failure further down the pipeline is always on an earlier item, so
+    # report that one, as handling the items one at a time would have done.
+    for stage in ('writing', 'processing', 'reading'):
+        if stage in errors:
+            item, exc_info = errors[stage]
+            print("Error while {} {}".format(stage, item))
+            raise exc_info[1].with_traceback(exc_info[2])
+
 
 class ReducerBase:
     def __init__(self, *arg, **kwd):
         self._apply_to = kwd.pop('apply_to', None)
         self._destination = kwd.pop('destination', None)
+        self._compression = kwd.pop('compression', None)
+        self._quantize_level = kwd.pop('quantize_level', DEFAULT_QUANTIZE_LEVEL)
+        self.compression_stats = CompressionStats()
 
     @property
     def destination(self):
@@ -47,11 +278,48 @@ class ReducerBase:
     def apply_to(self):
         return self._apply_to
 
+    @property
+    def compression(self):
+        return self._compression
+
+    def _write(self, hdulist, path, overwrite=False, ext=0):
+        """
+        Write ``hdulist`` to ``path``, tile-compressing the image if asked to.
+
+        When compressing, the file is read back once to time decompression,
+        and the sizes and times are added to ``compression_stats``.
+        """
+        if not self.compression:
+            hdulist.writeto(path, overwrite=overwrite)
+            return
+        from astropy.io import fits
+
+        raw_bytes = sum(hdu.filebytes() for hdu in hdulist)
+        compressed = compress_hdulist(hdulist, self.compression, self._quantize_level, ext)
+        start = time.time()
+        compressed.writeto(path, overwrite=overwrite)
+        write_time = time.time() - start
+        start = time.time()
+        fits.getdata(path, 1)
+        read_time = time.time() - start
+        self.compression_stats.add(raw_bytes, os.path.getsize(path), write_time, read_time)
+
 
 class Reduction(ReducerBase):
     """
     Primary widget for performing a logical reduction step (e.g. dark
     subtraction or flat correction).
+
+    With ``pipeline=True`` the next frames are read, and finished frames
+    written, in background threads while the current frame is calibrated.
+    ``pipeline_depth`` sets how many frames each thread may get ahead by.
+
+    With ``compression='rice'`` or ``'gzip'`` the reduced frames are written
+    as tile-compressed FITS; see `compress_hdulist`.
+
+    With ``cosmic_ray_reject=True`` cosmic rays are masked after the other
+    steps, and the mask is written to a ``MASK`` extension; see
+    `CosmicRayReject`.
     """
     def __init__(self, *arg, **kwd):
         allow_flat = kwd.pop('flat_correct', True)
@@ -59,6 +327,9 @@ class Reduction(ReducerBase):
         allow_dark_scale = kwd.pop('dark_scale', True)
         allow_bias = kwd.pop('bias_subtract', True)
         allow_copy = kwd.pop('copy_only', False)
+        allow_cosmic_ray = kwd.pop('cosmic_ray_reject', False)
+        self._pipelined = kwd.pop('pipeline', False)
+        self._pipeline_depth = kwd.pop('pipeline_depth', DEFAULT_PIPELINE_DEPTH)
         self.image_collection = kwd.pop('input_image_collection', None)
         self._master_source = kwd.pop('master_source', None)
         super(Reduction, self).__init__(*arg, **kwd)
@@ -66,6 +337,7 @@ class Reduction(ReducerBase):
         self._bias_calib = BiasSubtract(master_source=self._master_source)
         self._dark_calib = DarkSubtract(master_source=self._master_source, dark_scale=allow_dark_scale)
         self._flat_calib = FlatCorrect(master_source=self._master_source)
+        self._cosmic_ray_calib = CosmicRayReject()
 
         self.children = []
 
@@ -79,10 +351,21 @@ class Reduction(ReducerBase):
                 self.add_child(self._dark_calib)
             if allow_flat:
                 self.add_child(self._flat_calib)
+            if allow_cosmic_ray:
+                self.add_child(self._cosmic_ray_calib)
 
     def add_child(self, child):
         self.children.append(child)
 
+    @property
+    def _adds_extensions(self):
+        """
+        True if a child step adds extensions, such as a mask, to the output.
+        ``hdus`` only writes back the image itself, so these need the files
+        to be written explicitly.
+        """
+        return any(getattr(child, 'adds_mask', False) for child in self.children)
+
     def action(self):
         if not self.image_collection:
             raise ValueError("No images to reduce")
@@ -99,40 +382,100 @@ class Reduction(ReducerBase):
         # Suppress warnings that come up here...mostly about HIERARCH keywords
         warnings.filterwarnings('ignore')
         try:
-            current_file = 0
-            for hdu, fname in self.image_collection.hdus(return_fname=True,
-                                                         save_location=self.destination,
-                                                         overwrite=True,
-                                                         **self.apply_to):
-                current_file += 1
-                try:
-                    unit = hdu.header['BUNIT']
-                except KeyError:
-                    unit = DEFAULT_IMAGE_UNIT
-                ccd = ccdproc.CCDData(hdu.data, meta=hdu.header, unit=unit)
-                for child in self.children:
-                    ccd = child.action(ccd)
-
-                input_dtype = hdu.data.dtype.name
-                hdu_tmp = ccd.to_hdu()[0]
-                hdu.header = hdu_tmp.header
-                hdu.data = hdu_tmp.data
-                desired_dtype = REDUCE_IMAGE_DTYPE_MAPPING[str(input_dtype)]
-                if desired_dtype != hdu.data.dtype:
-                    hdu.data = hdu.data.astype(desired_dtype)
-
-                # Workaround to ensure uint16 images are handled properly.
-                if 'bzero' in hdu.header:
-                    # Check for the unsigned int16 case, and if our data type
-                    # is no longer uint16, delete BZERO and BSCALE
-                    header_unsigned_int = ((hdu.header['bscale'] == 1) and
-                                           (hdu.header['bzero'] == 32768))
-                    if (header_unsigned_int and (hdu.data.dtype != np.dtype('uint16'))):
-                        del hdu.header['bzero'], hdu.header['bscale']
+            if self._pipelined or self.compression or self._adds_extensions:
+                self._file_action()
+            else:
+                for hdu, fname in self.image_collection.hdus(return_fname=True,
+                                                             save_location=self.destination,
+                                                             overwrite=True,
+                                                             **self.apply_to):
+                    self._reduce_hdu(hdu)
         except IOError:
             print("One or more of the reduced images already exists. Delete "
                   "those files and try again. This class will NOT "
                   "overwrite existing files.")
+        if self.compression:
+            print(self.compression_stats.summary())
+
+    def _reduce_hdu(self, hdu):
+        """
+        Apply every child step to the image in ``hdu``, replacing its data and header.
+
+        Returns any extra HDUs, e.g. the mask, made when converting the
+        result back to FITS.
+        """
+        import ccdproc
+
+        try:
+            unit = hdu.header['BUNIT']
+        except KeyError:
+            unit = DEFAULT_IMAGE_UNIT
+        ccd = ccdproc.CCDData(hdu.data, meta=hdu.header, unit=unit)
+        for child in self.children:
+            ccd = child.action(ccd)
+
+        input_dtype = hdu.data.dtype.name
+        hdulist_tmp = ccd.to_hdu()
+        hdu_tmp = hdulist_tmp[0]
+        hdu.header = hdu_tmp.header
+        hdu.data = hdu_tmp.data
+        desired_dtype = REDUCE_IMAGE_DTYPE_MAPPING[str(input_dtype)]
+        if desired_dtype != hdu.data.dtype:
+            hdu.data = hdu.data.astype(desired_dtype)
+
+        # Workaround to ensure uint16 images are handled properly.
+        if 'bzero' in hdu.header:
+            # Check for the unsigned int16 case, and if our data type
+            # is no longer uint16, delete BZERO and BSCALE
+            header_unsigned_int = ((hdu.header['bscale'] == 1) and
+                                   (hdu.header['bzero'] == 32768))
+            if (header_unsigned_int and (hdu.data.dtype != np.dtype('uint16'))):
+                del hdu.header['bzero'], hdu.header['bscale']
+        return hdulist_tmp[1:]
+
+    def _file_action(self):
+        """
+        Reduce the images, opening and writing each file here rather than in
+        `ccdproc.ImageFileCollection.hdus`, so that reading, calibration and
+        writing can be overlapped and the output compressed.
+
+        Files are opened and written the same way as by ``hdus``, so the output
+        is otherwise identical to that of the sequential reduction.
+        """
+        from astropy.io import fits
+
+        paths = self.image_collection.files_filtered(include_path=True, **self.apply_to)
+        ext = self.image_collection.ext
+
+        def read(path):
+            hdulist = fits.open(path, memmap=False)
+            # Work on a copy of the image, as hdus() does; this also reads
+            # the data now, in this thread.
+            hdulist[ext] = hdulist[ext].copy()
+            return hdulist
+
+        def process(path, hdulist):
+            extensions = self._reduce_hdu(hdulist[ext])
+            for extension in extensions:
+                # replace the mask etc. from any earlier reduction of this file
+                if extension.name in hdulist:
+                    del hdulist[extension.name]
+                hdulist.append(extension)
+            return hdulist
+
+        def write(path, hdulist):
+            new_path = os.path.join(self.destination or os.path.dirname(path),
+                                    os.path.basename(path))
+            try:
+                self._write(hdulist, new_path, overwrite=True, ext=ext)
+            finally:
+                hdulist.close()
+
+        if self._pipelined:
+            _pipeline(paths, read, process, write, depth=self._pipeline_depth)
+        else:
+            for path in paths:
+                write(path, process(path, read(path)))
 
 
 class CopyFiles:
@@ -213,15 +556,19 @@ class Combiner(ReducerBase):
         for idx, combo_group in enumerate(groups_to_combine):
             combined = self._action_for_one_group(combo_group)
             name_addons = ['_'.join([str(k), str(v)])
-                           for k, v in six.iteritems(combo_group)]
+                           for k, v in combo_group.items()]
             fname = [self._file_base_name]
             fname.extend(name_addons)
             fname = '_'.join(fname) + '.fit'
             dest_path = os.path.join(self.destination, fname)
-            combined.write(dest_path, overwrite=True)
+            self._write(combined.to_hdu(), dest_path, overwrite=True)
             self._combined = combined
+        if self.compression:
+            print(self.compression_stats.summary())
 
     def _action_for_one_group(self, filter_dict=None):
+        import ccdproc
+
         combined_dict = self.apply_to.copy()
         if filter_dict is not None:
             combined_dict.update(filter_dict)
@@ -235,11 +582,14 @@ class Combiner(ReducerBase):
         if self._scaling:
             combine_keyword_args['scale'] = self._scaling_func
 
+        # the input files may themselves be tile-compressed
+        hdu = image_hdu_index(file_list[0])
         combined = ccdproc.combine(file_list,
                                    mem_limit=DEFAULT_MEMORY_LIMIT,
+                                   hdu=hdu,
                                    **combine_keyword_args)
 
-        sample_image = ccdproc.CCDData.read(file_list[0])
+        sample_image = ccdproc.CCDData.read(file_list[0], hdu=hdu)
         combined.header = sample_image.header
         combined.header['master'] = True
         if combined.data.dtype != sample_image.dtype:
@@ -291,6 +641,8 @@ class CalibrationStep:
             closest to the value in the dictionary instead of being an
             exact match.
         """
+        import ccdproc
+
         if not self._master_source:
             raise RuntimeError("No source provided for master.")
         file_name = self._master_source.files_filtered(master=True,
@@ -322,12 +674,14 @@ class CalibrationStep:
         try:
             return self._image_cache[path]
         except KeyError:
+            # Masters may be tile-compressed, with the image in an extension
+            hdu = image_hdu_index(path)
             # Try getting the unit form the FITS file, but force it to ADU
             try:
-                self._image_cache[path] = ccdproc.CCDData.read(path)
+                self._image_cache[path] = ccdproc.CCDData.read(path, hdu=hdu)
             except ValueError:
                 self._image_cache[path] = \
-                    ccdproc.CCDData.read(path, unit=DEFAULT_IMAGE_UNIT)
+                    ccdproc.CCDData.read(path, hdu=hdu, unit=DEFAULT_IMAGE_UNIT)
             return self._image_cache[path]
 
 
@@ -336,6 +690,8 @@ class BiasSubtract(CalibrationStep):
         super(BiasSubtract, self).__init__(**kwd)
 
     def action(self, ccd):
+        import ccdproc
+
         select_dict = {'imagetyp': 'bias'}
         try:
             master = self._master_image(select_dict)
@@ -352,6 +708,7 @@ class DarkSubtract(CalibrationStep):
         self.match_on = ['exposure']
 
     def action(self, ccd):
+        import ccdproc
         from astropy import units as u
         select_dict = {'imagetyp': 'dark frame'}
         for keyword in self.match_on:
@@ -386,6 +743,8 @@ class FlatCorrect(CalibrationStep):
         self.match_on = ['filter']
 
     def action(self, ccd):
+        import ccdproc
+
         select_dict = {'imagetyp': 'flat field'}
         for keyword in self.match_on:
             if keyword in select_dict:
@@ -398,3 +757,158 @@ class FlatCorrect(CalibrationStep):
             master = self._master_image(select_dict)
 
         return ccdproc.flat_correct(ccd, master)
+
+
+def _separable_median(data, size):
+    """
+    Median filter of a 2D image, approximated by 1D medians along each axis.
+
+    This is much faster than a full ``size`` x ``size`` median, and just as
+    good at removing features narrower than half the filter.
+    """
+    from scipy import ndimage
+
+    rows = ndimage.median_filter(data, size=(1, size), mode='nearest')
+    return ndimage.median_filter(rows, size=(size, 1), mode='nearest')
+
+
+def _laplacian(data):
+    """
+    Positive part of the Laplacian, as used by L.A.Cosmic, with the edges set to zero.
+
+    L.A.Cosmic subsamples the image by 2, takes the Laplacian, clips it at
+    zero and block-averages back to the original pixels. Each subpixel then
+    sees its own pixel twice and one neighbour along each axis, so the same
+    result comes from averaging ``2*centre - horizontal - vertical`` over the
+    four pairs of neighbours, without making the subsampled image.
+    """
+    lap = np.zeros_like(data)
+    centre = 2*data[1:-1, 1:-1]
+    inner = lap[1:-1, 1:-1]
+    for horizontal in (data[1:-1, :-2], data[1:-1, 2:]):
+        for vertical in (data[:-2, 1:-1], data[2:, 1:-1]):
+            inner += np.clip(centre - horizontal - vertical, 0, None)
+    inner /= 4
+    return lap
+
+
+# Pixels needed around a tile so that the filters in _cosmic_ray_tile give
+# the same result inside the tile as they would on the whole image.
+_TILE_MARGIN = 8
+
+
+def _cosmic_ray_tile(data, gain, readnoise, sigclip, sigfrac, objlim):
+    """
+    Cosmic ray mask for one tile of an image, by the method of L.A.Cosmic.
+
+    Cosmic rays are sharper than any real source, so they stand out in the
+    Laplacian of the image. Pixels whose Laplacian is large compared to the
+    noise are candidates; those that are also sharp compared to the local
+    fine structure (to spare the cores of stars) are cosmic rays. The mask
+    is then grown into neighbouring pixels that are less significant but
+    still sharp. See van Dokkum (2001), PASP 113, 1420.
+    """
+    from scipy import ndimage
+
+    lap = _laplacian(data)
+    background = _separable_median(data, 5)
+    noise = np.sqrt(np.clip(background, 0, None)*gain + readnoise**2)/gain
+    significance = lap/(2*noise)
+    significance -= _separable_median(significance, 5)
+    candidates = significance > sigclip
+
+    med3 = _separable_median(data, 3)
+    fine_structure = np.clip(med3 - _separable_median(med3, 7), 0.01, None)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cosmic_rays = candidates & (lap/fine_structure > objlim)
+
+    # grow into neighbours that are significant at the lower threshold
+    grown = ndimage.binary_dilation(cosmic_rays, structure=np.ones((3, 3), dtype=bool))
+    return cosmic_rays | (grown & (significance > sigfrac*sigclip))
+
+
+def cosmic_ray_mask(data, gain=1.0, readnoise=10.0, sigclip=4.5, sigfrac=0.3, objlim=5.0,
+                    tile_size=512, threads=None):
+    """
+    Find cosmic rays in an image, working on tiles in parallel.
+
+    The image is split into square tiles, each padded with enough of its
+    neighbours that the result does not depend on the tiling. The tiles are
+    processed on a pool of threads; the filtering is done in compiled
+    numpy and scipy code, so the threads spend little time holding the GIL.
+
+    Parameters
+    ----------
+    data : `numpy.ndarray`
+        Image, in ADU, with the bias removed
+    gain : float, optional
+        Gain of the detector, in electrons per ADU
+    readnoise : float, optional
+        Read noise, in electrons
+    sigclip : float, optional
+        Significance, in units of the noise, needed for a cosmic ray
+    sigfrac : float, optional
+        Fraction of ``sigclip`` needed for neighbouring pixels to be added
+    objlim : float, optional
+        How much sharper than the local structure a cosmic ray must be.
+        Raise this if the cores of stars are being masked.
+    tile_size : int, optional
+        Side of the tiles, in pixels
+    threads : int, optional
+        Number of threads. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    mask : `numpy.ndarray`
+        Boolean array, True for pixels affected by cosmic rays
+    """
+    data = np.asarray(data, dtype=float)
+    ny, nx = data.shape
+    padded = np.pad(data, _TILE_MARGIN, mode='reflect')
+    mask = np.zeros(data.shape, dtype=bool)
+
+    def one_tile(corner):
+        y0, x0 = corner
+        y1, x1 = min(y0 + tile_size, ny), min(x0 + tile_size, nx)
+        tile = padded[y0:y1 + 2*_TILE_MARGIN, x0:x1 + 2*_TILE_MARGIN]
+        tile_mask = _cosmic_ray_tile(tile, gain, readnoise, sigclip, sigfrac, objlim)
+        # each thread writes to its own part of the mask
+        mask[y0:y1, x0:x1] = tile_mask[_TILE_MARGIN:-_TILE_MARGIN, _TILE_MARGIN:-_TILE_MARGIN]
+
+    corners = [(y0, x0) for y0 in range(0, ny, tile_size) for x0 in range(0, nx, tile_size)]
+    with ThreadPoolExecutor(threads or os.cpu_count()) as pool:
+        # list() so that any exception in a tile is raised here
+        list(pool.map(one_tile, corners))
+    return mask
+
+
+class CosmicRayReject(CalibrationStep):
+    """
+    Mask cosmic rays, using `cosmic_ray_mask`.
+
+    The mask is combined with any mask the image already has. The gain is
+    taken from the ``EGAIN`` header keyword if it is not given.
+    """
+    adds_mask = True
+
+    def __init__(self, bias_image=None, **kwd):
+        self.gain = kwd.pop('gain', None)
+        self.gain_keyword = kwd.pop('gain_keyword', 'EGAIN')
+        self.readnoise = kwd.pop('readnoise', 10.0)
+        self.sigclip = kwd.pop('sigclip', 4.5)
+        self.sigfrac = kwd.pop('sigfrac', 0.3)
+        self.objlim = kwd.pop('objlim', 5.0)
+        self.tile_size = kwd.pop('tile_size', 512)
+        self.threads = kwd.pop('threads', None)
+        super(CosmicRayReject, self).__init__(**kwd)
+
+    def action(self, ccd):
+        gain = self.gain
+        if gain is None:
+            gain = ccd.header.get(self.gain_keyword, 1.0)
+        mask = cosmic_ray_mask(ccd.data, gain=gain, readnoise=self.readnoise,
+                               sigclip=self.sigclip, sigfrac=self.sigfrac, objlim=self.objlim,
+                               tile_size=self.tile_size, threads=self.threads)
+        ccd.mask = mask if ccd.mask is None else (ccd.mask | mask)
+        ccd.header['crmask'] = (int(mask.sum()), 'Pixels masked as cosmic rays')
+        return ccd
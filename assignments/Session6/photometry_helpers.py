@@ -1,17 +1,13 @@
+# photutils, astropy, scipy and matplotlib take a second or more to import
+# between them, so they are imported inside the functions that use them.
+# That way a script or worker process that only needs some of these
+# functions does not pay for the rest.
+import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 
-import astropy.stats as st
-from astropy.visualization import AsymmetricPercentileInterval
-from astropy.visualization.mpl_normalize import ImageNormalize
 import numpy as np
-import photutils as p
-from astropy.wcs import WCS
-from photutils.utils import calc_total_error
-from matplotlib import pyplot as plt
-from scipy.spatial import KDTree
-from astropy.nddata import Cutout2D
-from photutils.centroids import centroid_com
 
 
 def aperture_photometry(data, header, sources, aperture_radius, sky_inner_radius, sky_outer_radius):
@@ -46,6 +42,11 @@ def aperture_photometry(data, header, sources, aperture_radius, sky_inner_radius
     phot_table: `~astropy.table.Table`
         A table of measurements for each source, including instrumental magnitude and error.
     """
+    import astropy.stats as st
+    import photutils as p
+    from astropy.wcs import WCS
+    from photutils.utils import calc_total_error
+
     # make apertures around sources, and annuli for sky estimation
     positions = np.transpose((sources['xcentroid'], sources['ycentroid']))
     apertures = p.CircularAperture(positions, r=aperture_radius)
@@ -113,6 +114,11 @@ def plot_sources(data, sources, radius):
     radius: float
         The size of apertures to plot, in pixels
     """
+    import photutils as p
+    from astropy.visualization import AsymmetricPercentileInterval
+    from astropy.visualization.mpl_normalize import ImageNormalize
+    from matplotlib import pyplot as plt
+
     positions = np.transpose((sources['xcentroid'], sources['ycentroid']))
     apertures = p.CircularAperture(positions, r=radius)
     norm = ImageNormalize(data, interval=AsymmetricPercentileInterval(5, 95))
@@ -122,6 +128,13 @@ def plot_sources(data, sources, radius):
 
 
 def measure_FWHM(data, sources):
+    from astropy.nddata import Cutout2D
+    from astropy.visualization import AsymmetricPercentileInterval
+    from astropy.visualization.mpl_normalize import ImageNormalize
+    from matplotlib import pyplot as plt
+    from photutils.centroids import centroid_com
+    from scipy.spatial import KDTree
+
     # averagely bright stars
     lims = np.percentile(sources['flux'], (50, 60))
     mask = reduce(
@@ -157,3 +170,183 @@ def measure_FWHM(data, sources):
     axis[1].plot(R.ravel(), cutout.data.ravel(), '.')
     axis[1].set_xlabel('Distance from centre of star')
     axis[1].set_ylabel('Counts')
+
+
+def background_mesh(data, box_size=64, sigma=3.0, iters=5, filter_size=3):
+    """
+    Estimate the sky background and its noise on a coarse mesh of boxes.
+
+    The pixels in each box are sigma-clipped to remove stars, and the clipped
+    median and standard deviation taken. The mesh is then median filtered to
+    remove boxes spoilt by bright stars. The image is read one row of boxes
+    at a time, so no full-size copy of it is made.
+
+    Parameters
+    ----------
+    data:  `np.ndarray`
+        A 2D array of pixel values of your data.
+
+    box_size: int
+        Size of the boxes, in pixels. Should be several times larger than the stars.
+
+    sigma: float
+        Clipping threshold, in standard deviations
+
+    iters: int
+        Number of clipping iterations
+
+    filter_size: int
+        Size of the median filter applied to the mesh, in boxes
+
+    Returns
+    -------
+    background, noise: `np.ndarray`
+        Sky level and standard deviation in each box, with shape
+        (ceil(ny/box_size), ceil(nx/box_size))
+    """
+    from scipy import ndimage
+
+    ny, nx = data.shape
+    nby, nbx = -(-ny // box_size), -(-nx // box_size)
+    background = np.empty((nby, nbx))
+    noise = np.empty((nby, nbx))
+    for iy in range(nby):
+        strip = np.full((box_size, nbx*box_size), np.nan)
+        rows = data[iy*box_size:(iy+1)*box_size]
+        strip[:len(rows), :nx] = rows
+        boxes = strip.reshape(box_size, nbx, box_size).transpose(1, 0, 2).reshape(nbx, -1)
+        with warnings.catch_warnings():
+            # all-NaN boxes just give NaN
+            warnings.simplefilter('ignore')
+            for _ in range(iters):
+                median = np.nanmedian(boxes, axis=1)
+                std = np.nanstd(boxes, axis=1)
+                boxes[np.abs(boxes - median[:, None]) > sigma*std[:, None]] = np.nan
+            background[iy] = np.nanmedian(boxes, axis=1)
+            noise[iy] = np.nanstd(boxes, axis=1)
+    if filter_size > 1:
+        background = ndimage.median_filter(background, filter_size, mode='nearest')
+        noise = ndimage.median_filter(noise, filter_size, mode='nearest')
+    return background, noise
+
+
+def _interpolate_mesh(mesh, box_size, rows, cols):
+    """Bilinear interpolation of a mesh of box values, at the given pixel rows and columns"""
+    def weights(pixels, nbox):
+        # position in units of boxes, measured from the centre of the first box
+        pos = np.clip((pixels + 0.5)/box_size - 0.5, 0, nbox - 1)
+        lo = np.minimum(pos.astype(int), max(nbox - 2, 0))
+        hi = np.minimum(lo + 1, nbox - 1)
+        return lo, hi, (pos - lo)
+
+    ylo, yhi, wy = weights(rows, mesh.shape[0])
+    xlo, xhi, wx = weights(cols, mesh.shape[1])
+    along_x = mesh[:, xlo]*(1 - wx) + mesh[:, xhi]*wx
+    return along_x[ylo]*(1 - wy)[:, None] + along_x[yhi]*wy[:, None]
+
+
+def find_sources(data, fwhm=3.0, threshold=5.0, box_size=64, tile_size=512, threads=None):
+    """
+    Find stars in an image, working on tiles in parallel.
+
+    The sky background and noise are estimated on a coarse mesh with
+    `background_mesh` and interpolated, so they may vary across the image.
+    Each tile of the background-subtracted image is convolved with a Gaussian
+    of the given FWHM, which estimates the peak height of a star centred on
+    each pixel. Local maxima higher than ``threshold`` times the local noise
+    are kept, and their centroids and fluxes measured from the data.
+
+    Tiles are padded with their neighbours, so stars on the boundary between
+    tiles are found once and measured correctly. No full-size copy of the
+    image is made.
+
+    Parameters
+    ----------
+    data:  `np.ndarray`
+        A 2D array of pixel values of your data. From a FITS file, you can create this array with
+        `fits.getdata`.
+
+    fwhm: float
+        Full width at half maximum of the stars, in pixels
+
+    threshold: float
+        Detection threshold for the peak height of a star, in units of the
+        background standard deviation. This is like ``threshold`` for
+        `photutils.DAOStarFinder`, but relative to the local noise.
+
+    box_size: int
+        Size of the background mesh boxes, in pixels
+
+    tile_size: int
+        Size of the tiles, in pixels
+
+    threads: int
+        Number of threads. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    sources: `~astropy.table.Table`
+        A table with one row per star, and the columns ``id``, ``xcentroid``,
+        ``ycentroid``, ``peak``, ``flux`` and ``mag``, like the output of
+        `photutils.DAOStarFinder`. ``flux`` is the background-subtracted sum
+        over a box around the star.
+    """
+    from astropy.table import Table
+    from scipy import ndimage
+
+    ny, nx = data.shape
+    background, noise = background_mesh(data, box_size)
+    gauss_sigma = fwhm / 2.355
+    # stars must be the highest point within this distance
+    separation = max(1, int(round(fwhm)))
+    # half-width of the box used for centroids and fluxes
+    half_box = max(2, int(np.ceil(fwhm)))
+    margin = int(np.ceil(4*gauss_sigma)) + separation + half_box + 1
+
+    def one_tile(corner):
+        y0, x0 = corner
+        y1, x1 = min(y0 + tile_size, ny), min(x0 + tile_size, nx)
+        ya, yb = max(y0 - margin, 0), min(y1 + margin, ny)
+        xa, xb = max(x0 - margin, 0), min(x1 + margin, nx)
+        rows, cols = np.arange(ya, yb), np.arange(xa, xb)
+        sub = data[ya:yb, xa:xb] - _interpolate_mesh(background, box_size, rows, cols)
+        sub[~np.isfinite(sub)] = 0
+        # pad with sky at the edges of the image, so every tile is the same shape
+        pad = ((margin - (y0 - ya), margin - (yb - y1)), (margin - (x0 - xa), margin - (xb - x1)))
+        sub = np.pad(sub, pad, mode='constant')
+
+        # a normalised Gaussian filter gives half the peak height of a matching star
+        height = 2*ndimage.gaussian_filter(sub, gauss_sigma, mode='constant')
+        core = height[margin:-margin, margin:-margin]
+        local_max = ndimage.maximum_filter(height, 2*separation + 1)[margin:-margin, margin:-margin]
+        limit = threshold*_interpolate_mesh(noise, box_size, np.arange(y0, y1), np.arange(x0, x1))
+        iy, ix = np.nonzero((core == local_max) & (core > limit))
+
+        # gather a box of pixels around every peak at once
+        offsets = np.arange(-half_box, half_box + 1)
+        cy, cx = iy + margin, ix + margin
+        boxes = sub[cy[:, None, None] + offsets[None, :, None],
+                    cx[:, None, None] + offsets[None, None, :]]
+        flux = boxes.sum(axis=(1, 2))
+        weights = np.clip(boxes, 0, None)
+        total = weights.sum(axis=(1, 2))
+        total[total == 0] = 1
+        dy = (weights.sum(axis=2)*offsets).sum(axis=1) / total
+        dx = (weights.sum(axis=1)*offsets).sum(axis=1) / total
+        return (x0 + ix + dx, y0 + iy + dy, core[iy, ix], flux)
+
+    corners = [(y0, x0) for y0 in range(0, ny, tile_size) for x0 in range(0, nx, tile_size)]
+    with ThreadPoolExecutor(threads or os.cpu_count()) as pool:
+        results = list(pool.map(one_tile, corners))
+    xcentroid, ycentroid, peak, flux = (np.concatenate(column) for column in zip(*results))
+
+    order = np.lexsort((xcentroid, ycentroid))
+    sources = Table()
+    sources['id'] = np.arange(1, len(order) + 1)
+    sources['xcentroid'] = xcentroid[order]
+    sources['ycentroid'] = ycentroid[order]
+    sources['peak'] = peak[order]
+    sources['flux'] = flux[order]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sources['mag'] = -2.5*np.log10(sources['flux'])
+    return sources
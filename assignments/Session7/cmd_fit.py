@@ -0,0 +1,252 @@
+"""
+Fit the age, distance and extinction of a cluster to its colour-magnitude diagram.
+
+Rather than lining isochrones up with the data by eye, `fit_cmd` evaluates a
+likelihood for every combination of (log_age, distance, A_V) on a grid, and
+returns the posterior over the whole grid along with the best fit.
+
+The likelihood of each star depends on its distance from the isochrone, in
+units of the photometric errors. Distance and extinction only shift an
+isochrone rigidly in the CMD, so for each age a KD-tree is built once on the
+absolute isochrone, and the stars are shifted the opposite way for every
+(distance, A_V) pair and looked up in the same tree. Ages are spread over a
+pool of processes, and the shifted stars are queried in chunks so memory use
+does not grow with the size of the grid.
+
+Field stars and binaries that do not lie on the isochrone would dominate a
+plain chi-squared, so each star's likelihood is a mixture of a Gaussian
+around the isochrone and a flat background.
+
+Usage:
+
+    >>> from isochrone_grid import load_grid
+    >>> v, bv = load_cmd('example_data.csv')
+    >>> result = fit_cmd(load_grid(), bv, v, np.arange(9.1, 9.41, 0.01),
+    ...                  np.arange(600, 1001, 10), np.arange(0, 0.61, 0.02))
+    >>> print(result.best)
+"""
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+from scipy.spatial import KDTree
+
+from isochrone_grid import R_V
+
+# maximum number of star positions looked up in a KD-tree at once
+DEFAULT_CHUNK = 2**20
+
+CMDFit = namedtuple('CMDFit', ['log_age', 'distance', 'a_v', 'log_likelihood',
+                               'posterior', 'best'])
+CMDFit.__doc__ = """
+Result of `fit_cmd`.
+
+log_age, distance, a_v: `np.ndarray`
+    The parameter grid
+log_likelihood, posterior: `np.ndarray`
+    Log-likelihood, and posterior probability normalised to sum to one, with
+    shape (len(log_age), len(distance), len(a_v))
+best: tuple
+    The (log_age, distance, a_v) of the grid point with the highest likelihood
+"""
+
+
+def load_cmd(path):
+    """
+    Read a CSV file of V magnitudes and B-V colours, as made in Session 6.
+
+    Returns
+    -------
+    v, bv: `np.ndarray`
+    """
+    v, bv = np.loadtxt(path, delimiter=',', unpack=True, usecols=(0, 1))
+    return v, bv
+
+
+def densify(x, y, spacing=0.25):
+    """
+    Points along a curve, spaced closely enough to stand in for the curve itself.
+
+    Consecutive points of the curve are joined by straight lines, which are
+    subdivided so that no two neighbouring points are more than ``spacing``
+    apart. Non-finite points break the curve into separate pieces.
+
+    Parameters
+    ----------
+    x, y: `np.ndarray`
+        Points along the curve
+    spacing: float, optional
+        Largest gap left between points
+
+    Returns
+    -------
+    points: `np.ndarray`
+        Array of shape (npoints, 2)
+    """
+    points = np.column_stack([x, y])
+    finite = np.all(np.isfinite(points), axis=1)
+    start, end = points[:-1], points[1:]
+    joined = finite[:-1] & finite[1:]
+    start, end = start[joined], end[joined]
+
+    nsub = np.maximum(np.ceil(np.hypot(*(end - start).T) / spacing).astype(int), 1)
+    which = np.repeat(np.arange(len(start)), nsub)
+    # fraction of the way along each segment, excluding the end point
+    frac = np.arange(nsub.sum()) - np.repeat(np.cumsum(nsub) - nsub, nsub)
+    frac = (frac / np.repeat(nsub, nsub))[:, None]
+    inner = start[which] + frac*(end[which] - start[which])
+    return np.concatenate([inner, points[finite]])
+
+
+def _age_log_likelihood(curve, stars, shifts, outlier_fraction, clip, chunk):
+    """
+    Log-likelihood of the stars for one isochrone at every (distance, A_V) shift.
+
+    All positions are in units of the photometric errors. ``curve`` is the
+    absolute isochrone, ``stars`` the observed positions and ``shifts`` the
+    offset each (distance, A_V) pair applies to the isochrone.
+    """
+    lnl = np.empty(len(shifts))
+    if len(curve) == 0:
+        lnl[:] = -np.inf
+        return lnl
+    tree = KDTree(curve)
+    log_inlier = np.log1p(-outlier_fraction)
+    log_background = np.log(outlier_fraction) - clip**2/2
+    # beyond this radius the Gaussian is below a thousandth of the background,
+    # so leaving it out does not make the likelihood jump as stars cross it
+    radius = np.sqrt(max(2*(log_inlier - log_background + np.log(1e3)), 0))
+    step = max(chunk // len(stars), 1)
+    for start in range(0, len(shifts), step):
+        part = shifts[start:start + step]
+        # moving the stars back is the same as moving the isochrone forward
+        positions = stars[None, :, :] - part[:, None, :]
+        # stars further out are at the background level, so stop searching there
+        dist, _ = tree.query(positions.reshape(-1, 2), distance_upper_bound=radius)
+        dist = dist.reshape(len(part), len(stars))
+        lnl[start:start + step] = np.logaddexp(log_inlier - dist**2/2, log_background).sum(axis=1)
+    return lnl
+
+
+def fit_cmd(grid, bv, v, log_age, distance, a_v, sigma_bv=0.03, sigma_v=0.05,
+            outlier_fraction=0.2, clip=3.0, r_v=R_V, processes=None, chunk=DEFAULT_CHUNK):
+    """
+    Likelihood and posterior for a grid of cluster ages, distances and extinctions.
+
+    Parameters
+    ----------
+    grid: `isochrone_grid.IsochroneGrid`
+        Isochrones to compare with the data
+    bv, v: `np.ndarray`
+        Observed B-V colours and V magnitudes of the cluster stars
+    log_age, distance, a_v: array-like
+        Grid of log10(age/years), distance in parsecs, and V-band extinction
+    sigma_bv, sigma_v: float, optional
+        Uncertainty in the colours and magnitudes, setting how close a star
+        must be to the isochrone to count as a good fit
+    outlier_fraction: float, optional
+        Expected fraction of stars that do not lie on the isochrone
+    clip: float, optional
+        Sets the level of the background: its density is ``outlier_fraction``
+        times the height of the Gaussian at this distance from the isochrone,
+        in units of the errors. Stars far enough out that the Gaussian is
+        negligible all count equally as outliers.
+    r_v: float, optional
+        Ratio of total to selective extinction, A_V / E(B-V)
+    processes: int, optional
+        Number of worker processes. Defaults to the number of CPUs; use 1 to
+        do everything in this process.
+    chunk: int, optional
+        Maximum number of star positions looked up at once by each process
+
+    Returns
+    -------
+    result: `CMDFit`
+        The grid, log-likelihood, posterior and best fit. The prior is flat
+        on the grid.
+    """
+    log_age = np.atleast_1d(np.asarray(log_age, dtype=float))
+    distance = np.atleast_1d(np.asarray(distance, dtype=float))
+    a_v = np.atleast_1d(np.asarray(a_v, dtype=float))
+    scale = np.array([sigma_bv, sigma_v])
+    stars = np.column_stack([bv, v]) / scale
+    stars = stars[np.all(np.isfinite(stars), axis=1)]
+
+    # offset of the isochrone in the CMD for each (distance, A_V), in units of the errors
+    dist_grid, av_grid = np.meshgrid(distance, a_v, indexing='ij')
+    shifts = np.column_stack([(av_grid/r_v).ravel(),
+                              (5*np.log10(dist_grid/10) + av_grid).ravel()]) / scale
+
+    bv0, v0 = grid.absolute(log_age)
+    # a tenth of the error between points is close enough to the true curve
+    curves = [densify(x, y, spacing=0.1) for x, y in zip(bv0/scale[0], v0/scale[1])]
+
+    worker = partial(_age_log_likelihood, stars=stars, shifts=shifts,
+                     outlier_fraction=outlier_fraction, clip=clip, chunk=chunk)
+    if processes == 1:
+        lnl = [worker(curve) for curve in curves]
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            lnl = list(pool.map(worker, curves))
+    lnl = np.array(lnl).reshape(len(log_age), len(distance), len(a_v))
+
+    posterior = np.exp(lnl - lnl.max())
+    posterior /= posterior.sum()
+    i, j, k = np.unravel_index(np.argmax(lnl), lnl.shape)
+    return CMDFit(log_age, distance, a_v, lnl, posterior, (log_age[i], distance[j], a_v[k]))
+
+
+def marginal(result, parameter):
+    """
+    Posterior of one parameter, summed over the other two.
+
+    Parameters
+    ----------
+    result: `CMDFit`
+        Output of `fit_cmd`
+    parameter: str
+        One of 'log_age', 'distance' or 'a_v'
+
+    Returns
+    -------
+    values, probability: `np.ndarray`
+        The grid values of the parameter, and their marginal posterior
+    """
+    names = ('log_age', 'distance', 'a_v')
+    if parameter not in names:
+        raise ValueError("parameter must be one of {}".format(names))
+    axis = names.index(parameter)
+    others = tuple(i for i in range(3) if i != axis)
+    return getattr(result, parameter), result.posterior.sum(axis=others)
+
+
+if __name__ == "__main__":
+    import time
+    import matplotlib.pyplot as plt
+    from isochrone_grid import load_grid
+    plt.style.use('bmh')
+
+    v, bv = load_cmd(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example_data.csv'))
+    grid = load_grid()
+
+    start = time.time()
+    result = fit_cmd(grid, bv, v, np.arange(9.0, 9.51, 0.01), np.arange(500, 1201, 10),
+                     np.arange(0.0, 0.81, 0.02))
+    print('{} models in {:.1f} s'.format(result.posterior.size, time.time() - start))
+    best_age, best_distance, best_av = result.best
+    print('log age = {:.2f}, distance = {:.0f} pc, A_V = {:.2f}'.format(*result.best))
+
+    fig, axes = plt.subplots(ncols=4, figsize=(16, 4))
+    axes[0].scatter(bv, v, s=4, c='k')
+    model_bv, model_v = grid.apparent(best_age, best_distance, best_av)
+    axes[0].plot(model_bv, model_v)
+    axes[0].invert_yaxis()
+    axes[0].set_xlabel('B-V')
+    axes[0].set_ylabel('V')
+    for axis, name, label in zip(axes[1:], ('log_age', 'distance', 'a_v'),
+                                 ('log10(age/yr)', 'Distance (pc)', '$A_V$')):
+        axis.plot(*marginal(result, name))
+        axis.set_xlabel(label)
+    plt.show()
@@ -0,0 +1,251 @@
+"""
+Draw colour-magnitude and HR diagrams of very large catalogues.
+
+A scatter plot of a Gaia-sized catalogue needs every star in memory and one
+marker per star, which is slow to draw and just gives a black blob where the
+stars are dense. Instead, `HessDiagram` reads the catalogue a block at a
+time, counts the stars in each colour-magnitude bin with `np.bincount`, and
+only keeps the individual stars that fall in sparsely populated bins. The
+diagram is drawn as an image of the counts with those few stars scattered on
+top, so memory use is set by the number of bins rather than the number of
+stars, and drawing takes the same time however many stars there are.
+
+Usage:
+
+    >>> hess = HessDiagram(xrange=(-0.5, 4), yrange=(-4, 16))
+    >>> hess.add_catalog('gaia.fits', 'bp_rp', 'phot_g_mean_mag', parallax='parallax')
+    >>> fig, ax = plt.subplots()
+    >>> hess.draw(ax)
+    >>> ax.invert_yaxis()
+"""
+import numpy as np
+
+# number of rows read from a catalogue at once
+DEFAULT_CHUNK = 2**20
+
+
+def read_blocks(path, columns, chunk=DEFAULT_CHUNK, hdu=1):
+    """
+    Read columns from a CSV or FITS table a block of rows at a time.
+
+    FITS tables are memory-mapped, so only the rows in the current block are
+    read from disk. Any file that does not end in ``.fits``, ``.fit`` or
+    ``.fits.gz`` is read as CSV with a header row, using pandas.
+
+    Parameters
+    ----------
+    path: str
+        Path to the catalogue
+    columns: list
+        Names of the columns to read
+    chunk: int, optional
+        Number of rows in each block
+    hdu: int or str, optional
+        HDU containing the table, for FITS files
+
+    Yields
+    ------
+    block: tuple
+        One float `np.ndarray` per column
+    """
+    if path.lower().endswith(('.fits', '.fit', '.fits.gz')):
+        from astropy.io import fits
+        with fits.open(path, memmap=True) as hdulist:
+            table = hdulist[hdu].data
+            for start in range(0, len(table), chunk):
+                rows = table[start:start + chunk]
+                yield tuple(np.asarray(rows[name], dtype=float) for name in columns)
+    else:
+        import pandas as pd
+        for frame in pd.read_csv(path, usecols=list(columns), chunksize=chunk):
+            yield tuple(frame[name].to_numpy(dtype=float) for name in columns)
+
+
+def absolute_magnitude(mag, parallax):
+    """Absolute magnitude from apparent magnitude and parallax in milliarcseconds"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return mag + 5*np.log10(parallax/100)
+
+
+class HessDiagram(object):
+    """
+    A colour-magnitude diagram accumulated from a stream of stars.
+
+    Parameters
+    ----------
+    xrange, yrange: tuple
+        Limits of the diagram in colour and magnitude. Stars outside these
+        limits are counted in ``n_outside`` but not drawn.
+    bins: int or tuple, optional
+        Number of bins along each axis
+    min_count: int, optional
+        Bins with fewer stars than this are drawn as individual points
+        rather than as part of the image
+
+    Attributes
+    ----------
+    counts: `np.ndarray`
+        Number of stars in each bin, with shape (ny, nx)
+    xedges, yedges: `np.ndarray`
+        Bin edges
+    n_outside: int
+        Number of stars outside the diagram, or with missing values
+    """
+
+    def __init__(self, xrange, yrange, bins=(400, 400), min_count=5):
+        nx, ny = (bins, bins) if np.isscalar(bins) else bins
+        self.xedges = np.linspace(xrange[0], xrange[1], nx + 1)
+        self.yedges = np.linspace(yrange[0], yrange[1], ny + 1)
+        self.counts = np.zeros((ny, nx), dtype=np.int64)
+        self.min_count = min_count
+        self.n_outside = 0
+        # stars in bins that might turn out to be sparse. No bin ever holds
+        # more than min_count of them, so this stays small.
+        self._sparse = []
+
+    @property
+    def n_stars(self):
+        """Number of stars counted in the diagram"""
+        return int(self.counts.sum())
+
+    def _bin_index(self, x, y):
+        ny, nx = self.counts.shape
+        ix = np.floor((x - self.xedges[0]) / (self.xedges[1] - self.xedges[0])).astype(np.int64)
+        iy = np.floor((y - self.yedges[0]) / (self.yedges[1] - self.yedges[0])).astype(np.int64)
+        inside = (np.isfinite(x) & np.isfinite(y) &
+                  (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny))
+        return np.where(inside, iy*nx + ix, 0), inside
+
+    def add(self, x, y):
+        """
+        Add a block of stars to the diagram.
+
+        Parameters
+        ----------
+        x, y: `np.ndarray`
+            Colours and magnitudes of the stars
+        """
+        x = np.asarray(x, dtype=float).ravel()
+        y = np.asarray(y, dtype=float).ravel()
+        with np.errstate(invalid='ignore'):
+            idx, inside = self._bin_index(x, y)
+        self.n_outside += int(np.count_nonzero(~inside))
+        x, y, idx = x[inside], y[inside], idx[inside]
+
+        flat = self.counts.reshape(-1)
+        # keep a star if fewer than min_count stars have landed in its bin
+        # so far, counting those earlier in this block
+        order = np.argsort(idx, kind='stable')
+        sorted_idx = idx[order]
+        first = np.searchsorted(sorted_idx, sorted_idx, side='left')
+        rank = np.empty_like(idx)
+        rank[order] = np.arange(len(idx)) - first
+        keep = flat[idx] + rank < self.min_count
+        if np.any(keep):
+            self._sparse.append(np.column_stack([x[keep], y[keep], idx[keep]]))
+
+        flat += np.bincount(idx, minlength=flat.size)
+
+    def add_catalog(self, path, x, y, parallax=None, chunk=DEFAULT_CHUNK, hdu=1):
+        """
+        Add every star in a CSV or FITS catalogue, reading it in blocks.
+
+        Parameters
+        ----------
+        path: str
+            Path to the catalogue
+        x, y: str
+            Names of the colour and magnitude columns
+        parallax: str, optional
+            Name of a parallax column, in milliarcseconds. If given, the
+            magnitudes are converted to absolute magnitudes.
+        chunk: int, optional
+            Number of rows read at once
+        hdu: int or str, optional
+            HDU containing the table, for FITS files
+        """
+        columns = [x, y] if parallax is None else [x, y, parallax]
+        for block in read_blocks(path, columns, chunk, hdu):
+            colour, mag = block[0], block[1]
+            if parallax is not None:
+                mag = absolute_magnitude(mag, block[2])
+            self.add(colour, mag)
+
+    def sparse_stars(self):
+        """
+        The stars in bins with fewer than ``min_count`` stars.
+
+        Returns
+        -------
+        x, y: `np.ndarray`
+        """
+        if not self._sparse:
+            return np.empty(0), np.empty(0)
+        stars = np.concatenate(self._sparse)
+        self._sparse = [stars]
+        sparse = self.counts.reshape(-1)[stars[:, 2].astype(np.int64)] < self.min_count
+        return stars[sparse, 0], stars[sparse, 1]
+
+    def draw(self, ax, cmap='viridis', norm='log', s=1, color='k', **kwargs):
+        """
+        Draw the diagram on a matplotlib axis.
+
+        Bins with at least ``min_count`` stars are drawn as an image, and the
+        stars in the other bins as points.
+
+        Parameters
+        ----------
+        ax: `matplotlib.axes.Axes`
+            Axis to draw on
+        cmap: str or `matplotlib.colors.Colormap`, optional
+            Colour map for the image
+        norm: str or `matplotlib.colors.Normalize`, optional
+            Scaling of the image
+        s, color: optional
+            Size and colour of the points
+
+        Other keyword arguments are passed to `ax.pcolormesh`.
+
+        Returns
+        -------
+        mesh: `matplotlib.collections.QuadMesh`
+            The image, e.g. for use with ``plt.colorbar``
+        """
+        image = np.ma.masked_less(self.counts, self.min_count)
+        mesh = ax.pcolormesh(self.xedges, self.yedges, image, cmap=cmap, norm=norm,
+                             **kwargs)
+        x, y = self.sparse_stars()
+        ax.scatter(x, y, s=s, color=color, linewidths=0)
+        ax.set_xlim(self.xedges[0], self.xedges[-1])
+        ax.set_ylim(self.yedges[0], self.yedges[-1])
+        return mesh
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import matplotlib.pyplot as plt
+    plt.style.use('bmh')
+
+    hess = HessDiagram(xrange=(-0.5, 4.0), yrange=(-4, 16), bins=(300, 400))
+    if len(sys.argv) > 1:
+        # e.g. a Gaia query saved as FITS or CSV
+        hess.add_catalog(sys.argv[1], 'bp_rp', 'phot_g_mean_mag', parallax='parallax')
+    else:
+        # the cluster from example_data.csv, with a million simulated field stars
+        v, bv = np.loadtxt(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        'example_data.csv'), delimiter=',', unpack=True)
+        hess.add(bv, v - 10)
+        rng = np.random.default_rng(42)
+        for _ in range(10):
+            colour = rng.gamma(4, 0.25, 10**5)
+            hess.add(colour, 4*colour + rng.normal(0, 1.5, 10**5))
+
+    fig, ax = plt.subplots(figsize=(6, 7))
+    mesh = hess.draw(ax)
+    fig.colorbar(mesh, label='stars per bin')
+    ax.invert_yaxis()
+    ax.set_xlabel('Colour')
+    ax.set_ylabel('Absolute magnitude')
+    ax.set_title('{} stars'.format(hess.n_stars))
+    plt.show()
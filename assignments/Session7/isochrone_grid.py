@@ -0,0 +1,256 @@
+"""
+A cached grid of MIST isochrones for fitting cluster colour-magnitude diagrams.
+
+Every call to ``iso.isochrone(log_age)`` re-interpolates the full MIST model
+grid, which is slow when trying many ages. Here the isochrones are computed
+once on a fine grid of ages, stored on disk, and interpolated for whole
+arrays of ages at once.
+
+Each isochrone is stored against equivalent evolutionary phase (EEP) rather
+than mass. A star at a given EEP is at the same stage of evolution at every
+age, so interpolating between neighbouring ages at fixed EEP follows the
+turn-off and giant branch smoothly, where interpolating at fixed mass would
+not. The mass of each point is stored alongside its magnitudes.
+
+Usage:
+
+    >>> grid = load_grid()
+    >>> bv, v = grid.apparent([9.2, 9.235, 9.3], distance=800, a_v=0.3)
+    >>> bv.shape == (3, len(grid.eep))
+    True
+
+The ``isochrones`` package is only needed to build the grid the first time.
+"""
+import os
+
+import numpy as np
+
+DEFAULT_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'mist_bessell_bv.npz')
+
+# ages covered by the default grid, log10(years)
+DEFAULT_LOG_AGES = np.round(np.arange(6.5, 10.15 + 1e-9, 0.01), 2)
+
+# ratio of total to selective extinction, A_V / E(B-V)
+R_V = 3.1
+
+_CACHE_VERSION = 1
+BANDS = ('Bessell_B', 'Bessell_V')
+
+
+class IsochroneGrid(object):
+    """
+    MIST isochrones tabulated on a grid of (log_age, EEP).
+
+    Attributes
+    ----------
+    log_age: `np.ndarray`
+        Ages of the grid, log10(years), in increasing order
+    eep: `np.ndarray`
+        Equivalent evolutionary phases of the grid
+    mass, b_mag, v_mag: `np.ndarray`
+        Initial mass and absolute Bessell B and V magnitudes, with shape
+        (len(log_age), len(eep)). Phases not reached at a given age are NaN.
+    feh: float
+        Metallicity [Fe/H] of the isochrones
+    """
+
+    def __init__(self, log_age, eep, mass, b_mag, v_mag, feh=0.0):
+        self.log_age = np.asarray(log_age, dtype=float)
+        self.eep = np.asarray(eep)
+        self.mass = np.asarray(mass, dtype=float)
+        self.b_mag = np.asarray(b_mag, dtype=float)
+        self.v_mag = np.asarray(v_mag, dtype=float)
+        self.feh = float(feh)
+        if np.any(np.diff(self.log_age) <= 0):
+            raise ValueError("log_age must be strictly increasing")
+
+    def _weights(self, log_age):
+        """Grid index below each age, and the weight given to the grid point above"""
+        log_age = np.asarray(log_age, dtype=float)
+        lo, hi = self.log_age[0], self.log_age[-1]
+        if np.any((log_age < lo) | (log_age > hi)):
+            raise ValueError("log_age must lie between {} and {}".format(lo, hi))
+        idx = np.clip(np.searchsorted(self.log_age, log_age, side='right') - 1,
+                      0, len(self.log_age) - 2)
+        weight = (log_age - self.log_age[idx]) / (self.log_age[idx + 1] - self.log_age[idx])
+        return idx, weight[..., None]
+
+    def _interpolate(self, table, log_age):
+        idx, weight = self._weights(log_age)
+        return (1 - weight)*table[idx] + weight*table[idx + 1]
+
+    def masses(self, log_age):
+        """Initial mass at each EEP, for every age in log_age"""
+        return self._interpolate(self.mass, log_age)
+
+    def absolute(self, log_age):
+        """
+        Absolute, unreddened isochrones for an array of ages.
+
+        Parameters
+        ----------
+        log_age: float or array-like
+            log10 of the age in years
+
+        Returns
+        -------
+        bv, v: `np.ndarray`
+            B-V colour and V magnitude, with shape ``np.shape(log_age) + (neep,)``
+        """
+        b = self._interpolate(self.b_mag, log_age)
+        v = self._interpolate(self.v_mag, log_age)
+        return b - v, v
+
+    def apparent(self, log_age, distance, a_v, r_v=R_V):
+        """
+        Isochrones as they would be observed, corrected for distance and extinction.
+
+        The arguments are broadcast against each other, so a whole grid of
+        models can be made in one call, e.g. with ``log_age[:, None, None]``,
+        ``distance[None, :, None]`` and ``a_v[None, None, :]``. Each distinct
+        age is only interpolated once.
+
+        Parameters
+        ----------
+        log_age: float or array-like
+            log10 of the age in years
+        distance: float or array-like
+            Distance in parsecs
+        a_v: float or array-like
+            Extinction in the V band, in magnitudes
+        r_v: float, optional
+            Ratio of total to selective extinction, A_V / E(B-V)
+
+        Returns
+        -------
+        bv, v: `np.ndarray`
+            Observed B-V colour and V magnitude, with shape
+            ``np.broadcast_shapes(log_age, distance, a_v) + (neep,)``
+        """
+        log_age, distance, a_v = np.broadcast_arrays(np.asarray(log_age, dtype=float),
+                                                     np.asarray(distance, dtype=float),
+                                                     np.asarray(a_v, dtype=float))
+        ages, which = np.unique(log_age, return_inverse=True)
+        bv0, v0 = self.absolute(ages)
+        which = which.reshape(log_age.shape)
+        distance_modulus = 5*np.log10(distance/10)
+        v = v0[which] + (distance_modulus + a_v)[..., None]
+        bv = bv0[which] + (a_v/r_v)[..., None]
+        return bv, v
+
+    def save(self, path):
+        """Save the grid to a ``.npz`` file"""
+        np.savez_compressed(path, version=_CACHE_VERSION, log_age=self.log_age, eep=self.eep,
+                            mass=self.mass, b_mag=self.b_mag, v_mag=self.v_mag, feh=self.feh)
+
+    @classmethod
+    def read(cls, path):
+        """Read a grid written by `save`"""
+        with np.load(path) as npz:
+            if npz['version'] != _CACHE_VERSION:
+                raise ValueError("{} was written by a different version".format(path))
+            return cls(npz['log_age'], npz['eep'], npz['mass'], npz['b_mag'], npz['v_mag'],
+                       float(npz['feh']))
+
+
+def build_grid(log_ages=DEFAULT_LOG_AGES, feh=0.0):
+    """
+    Compute MIST isochrones on a grid of ages, using the ``isochrones`` package.
+
+    This calls ``iso.isochrone`` once per age, so it takes a while; use
+    `load_grid` to build the grid once and reuse it afterwards.
+
+    Parameters
+    ----------
+    log_ages: array-like, optional
+        Ages to compute, log10(years)
+    feh: float, optional
+        Metallicity [Fe/H]
+
+    Returns
+    -------
+    grid: `IsochroneGrid`
+    """
+    from isochrones import get_ichrone
+
+    iso = get_ichrone('mist', bands=list(BANDS))
+    log_ages = np.sort(np.asarray(log_ages, dtype=float))
+    models = [iso.isochrone(log_age, feh=feh) for log_age in log_ages]
+
+    eeps = [np.rint(model['eep'].to_numpy()).astype(int) for model in models]
+    eep_min = min(e.min() for e in eeps)
+    eep = np.arange(eep_min, max(e.max() for e in eeps) + 1)
+    shape = (len(log_ages), len(eep))
+    mass, b_mag, v_mag = np.full(shape, np.nan), np.full(shape, np.nan), np.full(shape, np.nan)
+    for i, (model, e) in enumerate(zip(models, eeps)):
+        mass[i, e - eep_min] = model['initial_mass']
+        b_mag[i, e - eep_min] = model['Bessell_B_mag']
+        v_mag[i, e - eep_min] = model['Bessell_V_mag']
+
+    # drop phases that no isochrone reaches
+    used = np.any(np.isfinite(v_mag), axis=0)
+    return IsochroneGrid(log_ages, eep[used], mass[:, used], b_mag[:, used], v_mag[:, used], feh)
+
+
+def load_grid(path=DEFAULT_CACHE, log_ages=DEFAULT_LOG_AGES, feh=0.0, rebuild=False):
+    """
+    Load the isochrone grid from disk, building and saving it first if needed.
+
+    The grid is rebuilt if the file is missing, was written by another
+    version of this module, or covers different ages or metallicity.
+
+    Parameters
+    ----------
+    path: str, optional
+        Location of the cached grid
+    log_ages: array-like, optional
+        Ages the grid should cover, log10(years)
+    feh: float, optional
+        Metallicity [Fe/H]
+    rebuild: bool, optional
+        Always rebuild the grid
+
+    Returns
+    -------
+    grid: `IsochroneGrid`
+    """
+    log_ages = np.sort(np.asarray(log_ages, dtype=float))
+    if not rebuild:
+        try:
+            grid = IsochroneGrid.read(path)
+        except (IOError, KeyError, ValueError):
+            pass
+        else:
+            if grid.feh == feh and np.array_equal(grid.log_age, log_ages):
+                return grid
+    grid = build_grid(log_ages, feh)
+    try:
+        grid.save(path)
+    except IOError:
+        # a read-only directory just means we rebuild next time
+        pass
+    return grid
+
+
+if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+    plt.style.use('bmh')
+
+    v_obs, bv_obs = np.loadtxt(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                            'example_data.csv'), delimiter=',', unpack=True)
+    grid = load_grid()
+
+    # three ages at once, all at the same distance and extinction
+    log_ages = np.log10([1.5e9, 1.7e9, 1.9e9])
+    bv, v = grid.apparent(log_ages, distance=850, a_v=0.25)
+
+    fig, axis = plt.subplots()
+    axis.scatter(bv_obs, v_obs, s=4, c='k')
+    for log_age, x, y in zip(log_ages, bv, v):
+        axis.plot(x, y, label='{:.1f} Gyr'.format(10**log_age/1e9))
+    axis.invert_yaxis()
+    axis.set_xlabel('B-V')
+    axis.set_ylabel('V')
+    axis.legend()
+    plt.show()
@@ -0,0 +1,349 @@
+"""Integrate many copies of an ODE system at once.
+
+In Session 4 the falling body and pendulum are solved one initial condition
+at a time, either with a Python loop or a call to ``odeint``. Exploring how
+the solution depends on, say, the drag coefficient then needs one call per
+value. The integrators here advance a whole batch of systems together.
+
+The derivative function has the same form as for ``odeint``,
+``func(state, time, *args)``, except that ``state`` is an array of shape
+(N, nstate) holding one state vector per row, and it must return an array
+of the same shape. ``time`` is an array of length N, since in the adaptive
+integrator every system has reached a different time. Any of the ``args``
+may also be an array of length N, giving each system its own parameters.
+
+Two integrators are provided:
+
+* `rk4` uses fixed-step fourth-order Runge-Kutta on the output times;
+* `rk45` uses the adaptive Dormand-Prince method, where every system has its
+  own step size, and interpolates the solution onto the output times.
+
+Both can stop individual systems when an event function changes sign, for
+example when a falling object hits the ground. Output arrays are allocated
+once at the start; systems that have stopped are filled with NaN.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+ODESolution = namedtuple('ODESolution', ['t', 'y', 't_event', 'y_event'])
+ODESolution.__doc__ = """
+Result of a batched integration.
+
+Attributes
+----------
+t: `np.ndarray`
+    Output times, shape (nt,)
+y: `np.ndarray`
+    Solution, shape (nt, N, nstate). NaN after a system stops at an event.
+t_event: `np.ndarray`
+    Time of the first event for each system, or NaN if there was none
+y_event: `np.ndarray`
+    State at the event, shape (N, nstate)
+"""
+
+# Dormand-Prince 5(4) coefficients
+_DP_C = np.array([0, 1/5, 3/10, 4/5, 8/9, 1, 1])
+_DP_A = [
+    [],
+    [1/5],
+    [3/40, 9/40],
+    [44/45, -56/15, 32/9],
+    [19372/6561, -25360/2187, 64448/6561, -212/729],
+    [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+    [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84],
+]
+_DP_B = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0])
+_DP_E = _DP_B - np.array([5179/57600, 0, 7571/16695, 393/640,
+                          -92097/339200, 187/2100, 1/40])
+
+# number of bisections used to locate events within a step
+_EVENT_ITERATIONS = 40
+
+
+def _take(args, idx, nsys):
+    """Select the systems ``idx`` from any per-system arrays in args"""
+    return tuple(arg[idx] if np.ndim(arg) > 0 and np.shape(arg)[0] == nsys else arg
+                 for arg in args)
+
+
+def _hermite(y0, f0, y1, f1, h, s):
+    """Cubic Hermite interpolation at fraction s (shape (N,)) of a step of length h"""
+    s = s[:, None]
+    h = h[:, None]
+    return ((1 + 2*s)*(1 - s)**2*y0 + s*(1 - s)**2*h*f0 +
+            s**2*(3 - 2*s)*y1 + s**2*(s - 1)*h*f1)
+
+
+def _locate_events(event, direction, t0, y0, f0, t1, y1, f1, args):
+    """
+    Find which systems have an event in the step from t0 to t1, and when.
+
+    Returns a boolean array flagging the systems with an event, and the
+    event times and states for those systems.
+    """
+    g0 = event(t0, y0, *args)
+    g1 = event(t1, y1, *args)
+    crossed = np.sign(g0) != np.sign(g1)
+    if direction > 0:
+        crossed &= g1 > g0
+    elif direction < 0:
+        crossed &= g1 < g0
+    if not np.any(crossed):
+        return crossed, None, None
+
+    # bisect on the interpolated solution for each system with a crossing
+    idx = np.flatnonzero(crossed)
+    sub = _take(args, idx, len(crossed))
+    h = (t1 - t0)[idx]
+    y0, f0, y1, f1 = y0[idx], f0[idx], y1[idx], f1[idx]
+    lo = np.zeros(len(idx))
+    hi = np.ones(len(idx))
+    glo = g0[idx]
+    for _ in range(_EVENT_ITERATIONS):
+        mid = 0.5*(lo + hi)
+        gmid = event(t0[idx] + mid*h, _hermite(y0, f0, y1, f1, h, mid), *sub)
+        same = np.sign(gmid) == np.sign(glo)
+        lo = np.where(same, mid, lo)
+        hi = np.where(same, hi, mid)
+        glo = np.where(same, gmid, glo)
+    return crossed, t0[idx] + hi*h, _hermite(y0, f0, y1, f1, h, hi)
+
+
+def rk4(func, y0, t, args=(), event=None, direction=0):
+    """
+    Integrate a batch of ODE systems with fixed-step fourth-order Runge-Kutta.
+
+    The step size is the spacing of the output times, which need not be
+    uniform.
+
+    Parameters
+    ----------
+    func: callable
+        ``func(state, time, *args)`` returning d(state)/dt, shape (N, nstate)
+    y0: `np.ndarray`
+        Initial states, shape (N, nstate). A single state of shape (nstate,)
+        is broadcast to match the length of any per-system arguments.
+    t: `np.ndarray`
+        Output times, starting at the initial time
+    args: tuple, optional
+        Extra arguments for func; each may be a scalar or an array of length N
+    event: callable, optional
+        ``event(time, state, *args)`` returning shape (N,). A system stops
+        when this changes sign.
+    direction: int, optional
+        Only trigger on rising (+1) or falling (-1) crossings. 0 means either.
+
+    Returns
+    -------
+    solution: `ODESolution`
+    """
+    t = np.asarray(t, dtype=float)
+    y = _initial_state(y0, args)
+    nsys, nstate = y.shape
+    out = np.full((len(t), nsys, nstate), np.nan)
+    out[0] = y
+    t_event = np.full(nsys, np.nan)
+    y_event = np.full((nsys, nstate), np.nan)
+    running = np.ones(nsys, dtype=bool)
+
+    for i in range(len(t) - 1):
+        idx = np.flatnonzero(running)
+        if len(idx) == 0:
+            break
+        sub = _take(args, idx, nsys)
+        ti, h = np.full(len(idx), t[i]), t[i + 1] - t[i]
+        yi = y[idx]
+        k1 = func(yi, ti, *sub)
+        k2 = func(yi + h/2*k1, ti + h/2, *sub)
+        k3 = func(yi + h/2*k2, ti + h/2, *sub)
+        k4 = func(yi + h*k3, ti + h, *sub)
+        ynew = yi + h/6*(k1 + 2*k2 + 2*k3 + k4)
+
+        if event is not None:
+            fnew = func(ynew, ti + h, *sub)
+            hit, te, ye = _locate_events(event, direction, ti, yi, k1,
+                                         ti + h, ynew, fnew, sub)
+            if np.any(hit):
+                t_event[idx[hit]] = te
+                y_event[idx[hit]] = ye
+                running[idx[hit]] = False
+                idx, ynew = idx[~hit], ynew[~hit]
+
+        y[idx] = ynew
+        out[i + 1, idx] = ynew
+    return ODESolution(t, out, t_event, y_event)
+
+
+def _initial_state(y0, args):
+    y0 = np.asarray(y0, dtype=float)
+    if y0.ndim == 2:
+        return y0.copy()
+    lengths = {np.shape(arg)[0] for arg in args if np.ndim(arg) > 0}
+    if len(lengths) > 1:
+        raise ValueError("Per-system arguments have different lengths: {}".format(lengths))
+    nsys = lengths.pop() if lengths else 1
+    return np.tile(y0, (nsys, 1))
+
+
+def rk45(func, y0, t, args=(), event=None, direction=0,
+         rtol=1.0e-6, atol=1.0e-9, first_step=None, max_steps=100000):
+    """
+    Integrate a batch of ODE systems with the adaptive Dormand-Prince method.
+
+    Every system chooses its own step size from its own error estimate, so
+    stiff regions of one system do not slow down the others. The solution is
+    interpolated onto the output times.
+
+    Parameters
+    ----------
+    func: callable
+        ``func(state, time, *args)`` returning d(state)/dt, shape (N, nstate)
+    y0: `np.ndarray`
+        Initial states, shape (N, nstate) or (nstate,)
+    t: `np.ndarray`
+        Increasing output times, starting at the initial time
+    args: tuple, optional
+        Extra arguments for func; each may be a scalar or an array of length N
+    event: callable, optional
+        ``event(time, state, *args)`` returning shape (N,). A system stops
+        when this changes sign.
+    direction: int, optional
+        Only trigger on rising (+1) or falling (-1) crossings. 0 means either.
+    rtol, atol: float, optional
+        Relative and absolute error tolerances per step
+    first_step: float, optional
+        Initial step size. Defaults to 1/100 of the first output interval.
+    max_steps: int, optional
+        Give up with a RuntimeError after this many steps
+
+    Returns
+    -------
+    solution: `ODESolution`
+    """
+    t = np.asarray(t, dtype=float)
+    y = _initial_state(y0, args)
+    nsys, nstate = y.shape
+    out = np.full((len(t), nsys, nstate), np.nan)
+    out[0] = y
+    t_event = np.full(nsys, np.nan)
+    y_event = np.full((nsys, nstate), np.nan)
+
+    tnow = np.full(nsys, t[0])
+    if first_step is None:
+        first_step = (t[-1] - t[0]) / max(len(t) - 1, 1) / 100
+    h = np.full(nsys, first_step)
+    fnow = func(y, tnow, *args)
+    # index of the next output time still to be filled, for each system
+    nxt = np.ones(nsys, dtype=int)
+    running = nxt < len(t)
+
+    for _ in range(max_steps):
+        idx = np.flatnonzero(running)
+        if len(idx) == 0:
+            break
+        sub = _take(args, idx, nsys)
+        t0, y0_, f0 = tnow[idx], y[idx], fnow[idx]
+        step = np.minimum(h[idx], t[-1] - t0)
+        hcol = step[:, None]
+
+        k = [f0]
+        for stage in range(1, 7):
+            ystage = y0_ + hcol*sum(a*ki for a, ki in zip(_DP_A[stage], k))
+            k.append(func(ystage, t0 + _DP_C[stage]*step, *sub))
+        ynew = y0_ + hcol*sum(b*ki for b, ki in zip(_DP_B, k) if b != 0)
+        error = hcol*sum(e*ki for e, ki in zip(_DP_E, k) if e != 0)
+        scale = atol + rtol*np.maximum(np.abs(y0_), np.abs(ynew))
+        err = np.sqrt(np.mean((error/scale)**2, axis=1))
+
+        # standard step size control, with a safety factor
+        with np.errstate(divide='ignore'):
+            factor = np.clip(0.9*err**-0.2, 0.2, 5.0)
+        h[idx] = step*factor
+        ok = err <= 1
+        if not np.any(ok):
+            continue
+        idx, t0, y0_, f0, step = idx[ok], t0[ok], y0_[ok], f0[ok], step[ok]
+        ynew, f1 = ynew[ok], k[6][ok]
+        t1 = t0 + step
+
+        stop = np.zeros(len(idx), dtype=bool)
+        tstop = t1.copy()
+        if event is not None:
+            hit, te, ye = _locate_events(event, direction, t0, y0_, f0, t1, ynew, f1,
+                                         _take(args, idx, nsys))
+            if np.any(hit):
+                t_event[idx[hit]] = te
+                y_event[idx[hit]] = ye
+                stop = hit
+                tstop[hit] = te
+
+        # interpolate onto every output time passed during this step
+        first = nxt[idx]
+        counts = np.maximum(np.searchsorted(t, tstop, side='right') - first, 0)
+        if counts.sum():
+            rows = np.repeat(np.arange(len(idx)), counts)
+            tout = first[rows] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            s = (t[tout] - t0[rows]) / step[rows]
+            out[tout, idx[rows]] = _hermite(y0_[rows], f0[rows], ynew[rows], f1[rows],
+                                            step[rows], s)
+            nxt[idx] += counts
+
+        tnow[idx], y[idx], fnow[idx] = t1, ynew, f1
+        running[idx[stop]] = False
+        running[idx] &= nxt[idx] < len(t)
+    else:
+        raise RuntimeError("Integration did not finish within {} steps".format(max_steps))
+    return ODESolution(t, out, t_event, y_event)
+
+
+def falling_body(state, time, cd, mass, rho, A, g=9.8):
+    """
+    Vertical motion with quadratic air drag, for a batch of objects.
+
+    The state vector is [vy, y], as in the Session 4 notebook. Drag always
+    opposes the motion. All parameters may be arrays of length N.
+
+    Returns
+    -------
+    deriv: `np.ndarray`
+        [dvy/dt, dy/dt] for every object, shape (N, 2)
+    """
+    vy = state[:, 0]
+    drag = 0.5*rho*cd*A*np.abs(vy)*vy/mass
+    return np.column_stack((-g - drag, vy))
+
+
+def pendulum(state, time, length=10.0, g=9.8):
+    """Simple pendulum with state vector [theta, omega], for a batch of pendulums"""
+    theta, omega = state[:, 0], state[:, 1]
+    return np.column_stack((omega, -g*np.sin(theta)/length))
+
+
+def hit_ground(time, state, *args):
+    """Event function for `falling_body`: the height of each object"""
+    return state[:, 1]
+
+
+if __name__ == "__main__":
+    import time
+    import matplotlib.pyplot as plt
+    plt.style.use('bmh')
+
+    # 10^4 drag coefficients, all dropped from the 78 m tower at once
+    cd = np.linspace(0.1, 2.0, 10000)
+    t = np.arange(0.0, 15.0, 0.01)
+    start = time.time()
+    sol = rk45(falling_body, [0.0, 78.0], t, args=(cd, 1.0, 1.2, 1.0),
+               event=hit_ground, direction=-1)
+    print('{} systems in {:.2f} s'.format(len(cd), time.time() - start))
+
+    fig, axes = plt.subplots(ncols=2, figsize=(12, 5))
+    for i in range(0, len(cd), 1000):
+        axes[0].plot(t, sol.y[:, i, 1], label='cd = {:.2f}'.format(cd[i]))
+    axes[0].set_xlabel('Time (seconds)')
+    axes[0].set_ylabel('Height (meters)')
+    axes[1].plot(cd, sol.t_event)
+    axes[1].set_xlabel('Drag coefficient')
+    axes[1].set_ylabel('Time to hit the ground (seconds)')
+    plt.show()
@@ -1,124 +1,226 @@
 import numpy as np
 from matplotlib import pyplot as plt
+from matplotlib.collections import LineCollection
 
-#----------------------------------------------------------------------
-# This function adjusts matplotlib settings for a uniform feel in the textbook.
-# Note that with usetex=True, fonts are rendered with LaTeX.  This may
-# result in an error if LaTeX is not installed on your system.  In that case,
-# you can set usetex to False.
-from astroML.plotting import setup_text_plots
-setup_text_plots(fontsize=8, usetex=True)
-
-#------------------------------------------------------------
-# Draw a figure and axis with no boundary
-fig = plt.figure(figsize=(5, 3.75), facecolor='w')
-ax = plt.axes([0, 0, 1, 1], xticks=[], yticks=[], frameon=False)
-
-def draw_cube(ax, xy, size, depth=0.4,
-              edges=None, label=None, label_kwargs=None, **kwargs):
-    """draw and label a cube.  edges is a list of numbers between
-    1 and 12, specifying which of the 12 cube edges to draw"""
-    if edges is None:
-        edges = range(1, 13)
-
-    x, y = xy
-
-    if 1 in edges:
-        ax.plot([x, x + size],
-                [y + size, y + size], **kwargs)
-    if 2 in edges:
-        ax.plot([x + size, x + size],
-                [y, y + size], **kwargs)
-    if 3 in edges:
-        ax.plot([x, x + size],
-                [y, y], **kwargs)
-    if 4 in edges:
-        ax.plot([x, x],
-                [y, y + size], **kwargs)
-
-    if 5 in edges:
-        ax.plot([x, x + depth],
-                [y + size, y + depth + size], **kwargs)
-    if 6 in edges:
-        ax.plot([x + size, x + size + depth],
-                [y + size, y + depth + size], **kwargs)
-    if 7 in edges:
-        ax.plot([x + size, x + size + depth],
-                [y, y + depth], **kwargs)
-    if 8 in edges:
-        ax.plot([x, x + depth],
-                [y, y + depth], **kwargs)
-
-    if 9 in edges:
-        ax.plot([x + depth, x + depth + size],
-                [y + depth + size, y + depth + size], **kwargs)
-    if 10 in edges:
-        ax.plot([x + depth + size, x + depth + size],
-                [y + depth, y + depth + size], **kwargs)
-    if 11 in edges:
-        ax.plot([x + depth, x + depth + size],
-                [y + depth, y + depth], **kwargs)
-    if 12 in edges:
-        ax.plot([x + depth, x + depth],
-                [y + depth, y + depth + size], **kwargs)
-
-    if label:
-        if label_kwargs is None:
-            label_kwargs = {}
-        ax.text(x + 0.5 * size, y + 0.5 * size, label,
-                ha='center', va='center', **label_kwargs)
-
-solid = dict(c='black', ls='-', lw=1,
-             label_kwargs=dict(color='k'))
-dotted = dict(c='black', ls=':', lw=0.5,
-              label_kwargs=dict(color='gray'))
+
+solid = dict(colors='black', linestyles='-', linewidths=1,
+             label_color='k')
+dotted = dict(colors='black', linestyles=':', linewidths=0.5,
+              label_color='gray')
 depth = 0.3
 
-#------------------------------------------------------------
-# Draw first example: 3x2 plus 2x1
-
-# first block
-draw_cube(ax, (1, 7.5), 1, depth, [1, 2, 3, 4, 5, 6, 9], '1', **solid)
-draw_cube(ax, (2, 7.5), 1, depth, [1, 2, 3, 6, 9], '1', **solid)
-draw_cube(ax, (3, 7.5), 1, depth, [1, 2, 3, 6, 7, 9, 10], '1', **solid)
-
-draw_cube(ax, (1, 6.5), 1, depth, [2, 3, 4], '1', **solid)
-draw_cube(ax, (2, 6.5), 1, depth, [2, 3], '1', **solid)
-draw_cube(ax, (3, 6.5), 1, depth, [2, 3, 7, 10], '1', **solid)
-
-# second block
-draw_cube(ax, (6, 7.5), 1, depth, [1, 2, 3, 4, 5, 6, 7, 9, 10], '1', **solid)
-draw_cube(ax, (6, 6.5), 1, depth, [1, 2, 3, 4, 7, 10], '1', **solid)
-
-draw_cube(ax, (7, 7.5), 1, depth, [1, 2, 3, 6, 7, 9, 10, 11], '1', **dotted)
-draw_cube(ax, (7, 6.5), 1, depth, [2, 3, 4, 7, 10, 11], '1', **dotted)
-
-draw_cube(ax, (8, 7.5), 1, depth, [1, 2, 3, 6, 7, 9, 10, 11], '1', **dotted)
-draw_cube(ax, (8, 6.5), 1, depth, [2, 3, 4, 7, 10, 11],  '1', **dotted)
-
-ax.text(5, 7.5, '+', size=12, ha='center', va='center')
-ax.text(1, 9.0, r'${\tt np.ones((2,\, 3)) + np.ones((2,1))}$',
-        size=12, ha='left', va='bottom')
-        
-#------------------------------------------------------------
-# Draw first example: 3x2 plus 1x2
-
-# first block
-draw_cube(ax, (1, 3), 1, depth, [1, 2, 3, 4, 5, 6, 9], '1', **solid)
-draw_cube(ax, (2, 3), 1, depth, [1, 2, 3, 6, 9], '1', **solid)
-draw_cube(ax, (3, 3), 1, depth, [1, 2, 3, 6, 7, 9, 10], '1', **solid)
-
-draw_cube(ax, (1, 2), 1, depth, [2, 3, 4], '1', **solid)
-draw_cube(ax, (2, 2), 1, depth, [2, 3], '1', **solid)
-draw_cube(ax, (3, 2), 1, depth, [2, 3, 7, 10], '1', **solid)
-
-# second block
-draw_cube(ax, (6,3), 1, depth, [1,2,3,4,5,6,9], '1', **solid)
-draw_cube(ax, (7,3), 1, depth, [1,2,3,6,7,9,10], '1', **solid)
-
-ax.text(5, 3.0, '+', size=12, ha='center', va='center')
-ax.text(1, 4.5, r'${\tt np.ones((2,\, 3)) + np.ones(2)}$',
-        size=12, ha='left', va='bottom')
-ax.set_xlim(0, 16)
-ax.set_ylim(0.5, 12.5)
-plt.show()
\ No newline at end of file
+
+def _as_3d(shape):
+    """Pad a shape of up to 3 dimensions to (layers, rows, cols)"""
+    shape = tuple(shape)
+    if len(shape) > 3:
+        raise ValueError("Can only draw arrays with up to 3 dimensions")
+    return (1,) * (3 - len(shape)) + shape
+
+
+def block_segments(xy, shape, size=1, depth=0.4):
+    """
+    Line segments outlining a block of cubes.
+
+    The block is drawn in oblique projection: the front face is a grid of
+    rows x cols squares with its lower left corner at xy, and each layer
+    recedes up and to the right by ``depth``. Only the visible faces (front,
+    top and right) are drawn, and every line is shared between neighbouring
+    cubes, so the number of segments grows with the size of the block's
+    edges rather than the number of cubes.
+
+    Parameters
+    ----------
+    xy: tuple
+        Position of the lower left corner of the front face
+    shape: tuple
+        Shape of the array, with up to 3 dimensions
+    size: float, optional
+        Side length of each cube
+    depth: float, optional
+        Offset in x and y of each layer behind the front face
+
+    Returns
+    -------
+    segments: `np.ndarray`
+        Array of shape (nseg, 2, 2), suitable for a `LineCollection`
+    """
+    layers, rows, cols = _as_3d(shape)
+    x0, y0 = xy
+    width, height, back = cols*size, rows*size, layers*depth
+    top, right = y0 + height, x0 + width
+    xs = x0 + size*np.arange(cols + 1, dtype=float)
+    ys = y0 + size*np.arange(rows + 1, dtype=float)
+    ds = depth*np.arange(layers + 1, dtype=float)
+
+    segments = [
+        # front face
+        np.stack([np.column_stack([xs, np.full_like(xs, y0)]),
+                  np.column_stack([xs, np.full_like(xs, top)])], axis=1),
+        np.stack([np.column_stack([np.full_like(ys, x0), ys]),
+                  np.column_stack([np.full_like(ys, right), ys])], axis=1),
+        # top face: lines running back from the front edge, then across at each layer
+        np.stack([np.column_stack([xs, np.full_like(xs, top)]),
+                  np.column_stack([xs + back, np.full_like(xs, top + back)])], axis=1),
+        np.stack([np.column_stack([x0 + ds, top + ds]),
+                  np.column_stack([right + ds, top + ds])], axis=1),
+        # right face
+        np.stack([np.column_stack([np.full_like(ys, right), ys]),
+                  np.column_stack([np.full_like(ys, right + back), ys + back])], axis=1),
+        np.stack([np.column_stack([right + ds, y0 + ds]),
+                  np.column_stack([right + ds, top + ds])], axis=1),
+    ]
+    return np.concatenate(segments)
+
+
+def block_centres(xy, shape, size=1):
+    """Centres of the front faces of a block of cubes, in row-major order from the top"""
+    _, rows, cols = _as_3d(shape)
+    x0, y0 = xy
+    xc = x0 + size*(np.arange(cols) + 0.5)
+    yc = y0 + size*(rows - np.arange(rows) - 0.5)
+    X, Y = np.meshgrid(xc, yc)
+    return np.column_stack([X.ravel(), Y.ravel()])
+
+
+def _label_values(values, shape):
+    """Text for each front-face cell of an array of the given shape"""
+    if values is None:
+        return None
+    values = np.broadcast_to(np.asarray(values), _as_3d(shape))[0]
+    return np.array([str(v) for v in values.ravel()])
+
+
+def broadcast_diagram(ax, shape_a, shape_b, xy=(1, 1), size=1, depth=0.3,
+                      values_a=1, values_b=1, show_result=True, gap=2,
+                      label_size=8, solid=solid, dotted=dotted):
+    """
+    Draw a diagram of two arrays being broadcast together.
+
+    Each operand is drawn as a block of cubes. Cells of an operand that only
+    exist because of broadcasting are drawn dotted, and the result is drawn
+    after an equals sign.
+
+    All the outlines for one line style go into a single `LineCollection`,
+    and all the labels with the same text go into a single scatter artist
+    that uses the text as its marker, so the number of artists does not
+    depend on the size of the arrays.
+
+    Parameters
+    ----------
+    ax: `matplotlib.axes.Axes`
+        Axes to draw on
+    shape_a, shape_b: tuple
+        Shapes of the two operands, with up to 3 dimensions each
+    xy: tuple, optional
+        Lower left corner of the first operand
+    size: float, optional
+        Side length of each cube
+    depth: float, optional
+        Offset of each layer behind the front face
+    values_a, values_b: array-like, optional
+        Values to write on the front face of each operand, broadcast to its
+        shape. Use None for no labels.
+    show_result: bool, optional
+        Draw the result of the operation
+    gap: float, optional
+        Horizontal space between blocks
+    label_size: float, optional
+        Size of the cell labels, in points
+    solid, dotted: dict, optional
+        Line styles for real and broadcast cells. ``label_color`` sets the
+        colour of their labels; other keys go to `LineCollection`.
+
+    Returns
+    -------
+    result_shape: tuple
+        The shape of the broadcast result
+    """
+    result = np.broadcast_shapes(tuple(shape_a), tuple(shape_b))
+    _, rows, _ = _as_3d(result)
+    x, y0 = xy
+
+    lines = {'solid': [], 'dotted': []}
+    labels = {'solid': ([], []), 'dotted': ([], [])}
+    symbols = []
+
+    def add_block(x, y, shape, values, style):
+        lines[style].append(block_segments((x, y), shape, size, depth))
+        text = _label_values(values, shape)
+        if text is not None:
+            points, strings = labels[style]
+            points.append(block_centres((x, y), shape, size))
+            strings.append(text)
+
+    full = _as_3d(result)
+    block_width = full[2]*size + full[0]*depth
+    for i, (shape, values) in enumerate([(shape_a, values_a), (shape_b, values_b)]):
+        padded = _as_3d(shape)
+        if padded != full:
+            # broadcast cells first, so the real cells are drawn over them
+            stretched = None
+            if values is not None:
+                stretched = np.broadcast_to(np.broadcast_to(np.asarray(values), padded), full)
+            add_block(x, y0, full, stretched, 'dotted')
+        # the real cells sit at the top left of the broadcast block
+        add_block(x, y0 + (full[1] - padded[1])*size, padded, values, 'solid')
+        x += block_width
+        symbols.append((x + gap/2, '+' if i == 0 else '='))
+        x += gap
+
+    if show_result:
+        values = None
+        if values_a is not None and values_b is not None:
+            values = np.asarray(values_a) + np.asarray(values_b)
+        add_block(x, y0, result, values, 'solid')
+    else:
+        symbols.pop()
+
+    centre = y0 + rows*size/2
+    for xs, symbol in symbols:
+        ax.text(xs, centre, symbol, size=12, ha='center', va='center')
+
+    for style, kwargs in (('dotted', dotted), ('solid', solid)):
+        kwargs = dict(kwargs)
+        label_color = kwargs.pop('label_color', 'k')
+        if lines[style]:
+            ax.add_collection(LineCollection(np.concatenate(lines[style]), **kwargs))
+        points, strings = labels[style]
+        if points:
+            points = np.concatenate(points)
+            strings = np.concatenate(strings)
+            for text in np.unique(strings):
+                match = strings == text
+                ax.scatter(points[match, 0], points[match, 1], marker='${}$'.format(text),
+                           s=label_size**2, c=label_color, linewidths=0)
+    return result
+
+
+if __name__ == "__main__":
+    #----------------------------------------------------------------------
+    # This function adjusts matplotlib settings for a uniform feel in the textbook.
+    # Note that with usetex=True, fonts are rendered with LaTeX.  This may
+    # result in an error if LaTeX is not installed on your system.  In that case,
+    # you can set usetex to False.
+    from astroML.plotting import setup_text_plots
+    setup_text_plots(fontsize=8, usetex=True)
+
+    #------------------------------------------------------------
+    # Draw a figure and axis with no boundary
+    fig = plt.figure(figsize=(5, 3.75), facecolor='w')
+    ax = plt.axes([0, 0, 1, 1], xticks=[], yticks=[], frameon=False)
+
+    #------------------------------------------------------------
+    # Draw first example: 3x2 plus 2x1
+    broadcast_diagram(ax, (2, 3), (2, 1), xy=(1, 6.5), depth=depth, show_result=False)
+    ax.text(1, 9.0, r'${\tt np.ones((2,\, 3)) + np.ones((2,1))}$',
+            size=12, ha='left', va='bottom')
+
+    #------------------------------------------------------------
+    # Draw second example: 3x2 plus 3
+    broadcast_diagram(ax, (2, 3), (3,), xy=(1, 2), depth=depth, show_result=False)
+    ax.text(1, 4.5, r'${\tt np.ones((2,\, 3)) + np.ones(3)}$',
+            size=12, ha='left', va='bottom')
+    ax.set_xlim(0, 16)
+    ax.set_ylim(0.5, 12.5)
+    plt.show()
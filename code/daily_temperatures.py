@@ -0,0 +1,331 @@
+"""Binary cache and streaming aggregation for daily temperature series.
+
+Files like ``data/Session1/td_stockholm.dat`` hold one line per day::
+
+    #year month day min   temperature   max flag
+    1800  1  1    -6.1    -6.1    -6.1 1
+
+`load_daily` parses such a file once into a structured ``.npy`` file next to
+the source, and memory-maps it on later calls. The cache is rebuilt whenever
+the source is modified after the cache was written.
+
+The aggregation functions work through the records in fixed-size chunks and
+combine the results with `np.bincount`, so they never hold more than one chunk
+of a memory-mapped series in RAM. They accept any structured array with
+``year``, ``month`` and ``day`` fields, in any order, so longer series or
+pieces of one series concatenated together can be processed in the same way.
+Only `rolling_mean` needs the records in date order. There is no station
+field, so records from different stations would be averaged together.
+"""
+import os
+import tempfile
+from itertools import islice
+
+import numpy as np
+
+DEFAULT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', 'data', 'Session1', 'td_stockholm.dat')
+
+DAILY_DTYPE = np.dtype([
+    ('year', 'i2'),
+    ('month', 'i1'),
+    ('day', 'i1'),
+    ('min', 'f4'),
+    ('temperature', 'f4'),
+    ('max', 'f4'),
+    ('flag', 'i1'),
+])
+
+# number of records processed at once; roughly 8 MB of temporaries per chunk
+DEFAULT_CHUNK = 2**18
+
+# cumulative days before the start of each month, in a non-leap year
+_MONTH_START = np.array([0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334])
+
+
+def _record_lines(fh):
+    """The lines of an open daily temperature file that hold records"""
+    return (line for line in fh if line.strip() and not line.startswith('#'))
+
+
+def _count_records(source):
+    """Number of records in a file, counted without parsing"""
+    with open(source, 'r') as fh:
+        return sum(1 for _ in _record_lines(fh))
+
+
+def parse_daily(source, destination, chunk=DEFAULT_CHUNK):
+    """
+    Parse a daily temperature text file into a structured ``.npy`` file.
+
+    The file is read ``chunk`` lines at a time and written directly into a
+    memory-mapped output, so files much larger than RAM can be converted.
+
+    Parameters
+    ----------
+    source: str
+        Path to the text file
+    destination: str
+        Path of the ``.npy`` file to write
+    chunk: int, optional
+        Number of lines to parse at once
+    """
+    nrec = _count_records(source)
+    # write to a temporary file first so an interrupted parse never leaves
+    # a cache that looks valid
+    fd, tmp = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(os.path.abspath(destination)))
+    os.close(fd)
+    try:
+        out = np.lib.format.open_memmap(tmp, mode='w+', dtype=DAILY_DTYPE, shape=(nrec,))
+        start = 0
+        with open(source, 'r') as fh:
+            lines = _record_lines(fh)
+            while True:
+                block = list(islice(lines, chunk))
+                if not block:
+                    break
+                values = np.loadtxt(block, ndmin=2)
+                stop = start + len(values)
+                for idx, name in enumerate(DAILY_DTYPE.names):
+                    out[name][start:stop] = values[:, idx]
+                start = stop
+        out.flush()
+        del out
+        if start != nrec:
+            raise ValueError("Expected {} records in {} but parsed {}".format(nrec, source, start))
+        os.replace(tmp, destination)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def load_daily(source=DEFAULT_SOURCE, cache=None):
+    """
+    Memory-mapped daily temperature records, parsing the source if needed.
+
+    Parameters
+    ----------
+    source: str, optional
+        Path to the text file. Defaults to the Stockholm series.
+    cache: str, optional
+        Path of the binary cache. Defaults to the source path with a
+        ``.npy`` extension.
+
+    Returns
+    -------
+    data: `np.memmap`
+        Read-only structured array with fields ``year``, ``month``, ``day``,
+        ``min``, ``temperature``, ``max`` and ``flag``
+    """
+    if cache is None:
+        cache = os.path.splitext(source)[0] + '.npy'
+    if not os.path.exists(cache) or os.path.getmtime(cache) < os.path.getmtime(source):
+        parse_daily(source, cache)
+    return np.load(cache, mmap_mode='r')
+
+
+def _chunks(data, chunk):
+    for start in range(0, len(data), chunk):
+        yield start, data[start:start + chunk]
+
+
+def day_of_year(year, month, day):
+    """
+    Day of year (0-365) for arrays of dates.
+
+    February 29th is given index 59 and all dates from March 1st on are
+    shifted by one, so the same calendar date has the same index every year.
+    """
+    month = np.asarray(month, dtype=int)
+    doy = _MONTH_START[month - 1] + np.asarray(day, dtype=int) - 1
+    # leave a slot for February 29th by moving every date from March on forward one day
+    return doy + (month > 2)
+
+
+def _year_range(data, chunk):
+    """First and last year in a series, which need not be in date order"""
+    first, last = None, None
+    for _, block in _chunks(data, chunk):
+        lo, hi = int(block['year'].min()), int(block['year'].max())
+        first = lo if first is None else min(first, lo)
+        last = hi if last is None else max(last, hi)
+    if first is None:
+        raise ValueError("No records in the series")
+    return first, last
+
+
+def _grouped_mean(data, keys_func, nkeys, field, chunk):
+    total = np.zeros(nkeys)
+    count = np.zeros(nkeys)
+    for _, block in _chunks(data, chunk):
+        values = np.asarray(block[field], dtype=float)
+        keys = keys_func(block)
+        good = np.isfinite(values)
+        total += np.bincount(keys[good], weights=values[good], minlength=nkeys)
+        count += np.bincount(keys[good], minlength=nkeys)
+    with np.errstate(invalid='ignore'):
+        return total / count, count
+
+
+def yearly_mean(data, field='temperature', chunk=DEFAULT_CHUNK):
+    """
+    Mean of a field for every year in the series.
+
+    Parameters
+    ----------
+    data: `np.ndarray`
+        Structured array of daily records, as returned by `load_daily`.
+        The records can be in any order.
+    field: str, optional
+        Name of the field to average
+    chunk: int, optional
+        Number of records to process at once
+
+    Returns
+    -------
+    years: `np.ndarray`
+        The years covered by the series
+    mean: `np.ndarray`
+        Mean value for each year; NaN for years with no data
+    """
+    first, last = _year_range(data, chunk)
+    mean, _ = _grouped_mean(data, lambda b: b['year'].astype(int) - first,
+                            last - first + 1, field, chunk)
+    return np.arange(first, last + 1), mean
+
+
+def monthly_mean(data, field='temperature', chunk=DEFAULT_CHUNK):
+    """
+    Mean of a field for every month in the series.
+
+    Parameters are as for `yearly_mean`.
+
+    Returns
+    -------
+    years, months: `np.ndarray`
+        Year and month (1-12) of each entry
+    mean: `np.ndarray`
+        Mean value for each month; NaN for months with no data
+    """
+    first, last = _year_range(data, chunk)
+    nyears = last - first + 1
+
+    def keys(block):
+        return (block['year'].astype(int) - first)*12 + block['month'].astype(int) - 1
+
+    mean, _ = _grouped_mean(data, keys, 12*nyears, field, chunk)
+    years = np.repeat(np.arange(first, last + 1), 12)
+    months = np.tile(np.arange(1, 13), nyears)
+    return years, months, mean
+
+
+def climatology(data, field='temperature', chunk=DEFAULT_CHUNK):
+    """
+    Mean value of a field on each calendar day, averaged over all years.
+
+    Returns
+    -------
+    clim: `np.ndarray`
+        Array of 366 values indexed by `day_of_year`
+    """
+    def keys(block):
+        return day_of_year(block['year'], block['month'], block['day'])
+
+    clim, _ = _grouped_mean(data, keys, 366, field, chunk)
+    return clim
+
+
+def anomalies(data, field='temperature', clim=None, out=None, chunk=DEFAULT_CHUNK):
+    """
+    Daily departures from the climatological mean.
+
+    Parameters
+    ----------
+    data: `np.ndarray`
+        Structured array of daily records
+    field: str, optional
+        Name of the field to use
+    clim: `np.ndarray`, optional
+        Climatology from `climatology`. Calculated if not given.
+    out: `np.ndarray`, optional
+        Array to write the result to, e.g. a memory-mapped file for series
+        larger than RAM. A new float32 array is allocated if not given.
+
+    Returns
+    -------
+    anom: `np.ndarray`
+        The anomaly for each record
+    """
+    if clim is None:
+        clim = climatology(data, field, chunk)
+    if out is None:
+        out = np.empty(len(data), dtype='f4')
+    for start, block in _chunks(data, chunk):
+        doy = day_of_year(block['year'], block['month'], block['day'])
+        out[start:start + len(block)] = block[field] - clim[doy]
+    return out
+
+
+def rolling_mean(data, window, field='temperature', out=None, chunk=DEFAULT_CHUNK):
+    """
+    Trailing running mean of a field over ``window`` consecutive records.
+
+    Each chunk is extended backwards by ``window - 1`` records, so the result
+    is identical to processing the whole series at once. Missing (NaN) values
+    are ignored, and the first ``window - 1`` records are NaN.
+
+    Parameters
+    ----------
+    data: `np.ndarray`
+        Structured array of daily records, in date order
+    window: int
+        Number of records in the running window
+    field: str, optional
+        Name of the field to average
+    out: `np.ndarray`, optional
+        Array to write the result to. A new float32 array is allocated if
+        not given.
+
+    Returns
+    -------
+    mean: `np.ndarray`
+        The running mean ending at each record
+    """
+    if window < 1:
+        raise ValueError("window must be at least 1")
+    if out is None:
+        out = np.empty(len(data), dtype='f4')
+    values = data[field]
+    for start in range(0, len(data), chunk):
+        stop = min(start + chunk, len(data))
+        lo = max(start - window + 1, 0)
+        block = np.asarray(values[lo:stop], dtype=float)
+        good = np.isfinite(block)
+        csum = np.concatenate([[0.0], np.cumsum(np.where(good, block, 0.0))])
+        ccount = np.concatenate([[0], np.cumsum(good)])
+        # index of each output record within the extended block
+        idx = np.arange(start, stop) - lo + 1
+        left = idx - window
+        valid = left >= 0
+        left = np.maximum(left, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (csum[idx] - csum[left]) / (ccount[idx] - ccount[left])
+        out[start:stop] = np.where(valid, mean, np.nan)
+    return out
+
+
+if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+    plt.style.use('bmh')
+
+    data = load_daily()
+    years, mean = yearly_mean(data)
+    smooth = rolling_mean(data, 365*10)
+
+    fig, axis = plt.subplots()
+    axis.plot(years + 0.5, mean, '.', label='Yearly mean')
+    axis.plot(data['year'] + (data['month'] - 0.5)/12, smooth, label='10 year running mean')
+    axis.set_xlabel('Year')
+    axis.set_ylabel('Temperature (C)')
+    axis.legend()
+    plt.show()
@@ -0,0 +1,218 @@
+"""Cached loading of the gapminder dataset, and an animated Rosling plot.
+
+Parsing the tab-separated text file is by far the slowest part of making a
+Rosling plot. `load_gapminder` parses it once, sorts it by year and continent,
+and saves the columns to a compressed ``.npz`` file next to the source, with
+country and continent stored as categorical codes. The cache is rebuilt
+whenever the source file is newer than the cache.
+
+Because the table is sorted, each year, and each continent within a year, is
+a contiguous slice of rows and no boolean masks need to be built when plotting.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', 'data', 'Session2', 'gapminderDataFiveYear.txt')
+
+CONTINENT_COLOURS = dict(
+    Asia='#1f77b4',
+    Europe='#ff7f0e',
+    Africa='#2ca02c',
+    Americas='#d62728',
+    Oceania='#9467bd'
+)
+
+COLUMNS = ('country', 'year', 'pop', 'continent', 'lifeExp', 'gdpPercap')
+NUMERIC_COLUMNS = ('year', 'pop', 'lifeExp', 'gdpPercap')
+CATEGORICAL_COLUMNS = ('country', 'continent')
+
+# bump this if the layout of the cache file changes
+_CACHE_VERSION = 1
+
+
+class GapminderData:
+    """
+    The gapminder table, together with indices by year and continent.
+
+    Attributes
+    ----------
+    df: `pandas.DataFrame`
+        The full table, sorted by year, continent and country. Country and
+        continent are categorical columns.
+    year_slices: dict
+        Maps each year to the `slice` of rows of ``df`` for that year
+    continent_slices: dict
+        Maps each year to a dict mapping each continent to the `slice` of
+        rows of ``df`` for that continent in that year
+    """
+    def __init__(self, df):
+        self.df = df
+        years = df['year'].to_numpy()
+        starts = np.flatnonzero(np.r_[True, years[1:] != years[:-1]])
+        stops = np.r_[starts[1:], len(years)]
+        self.year_slices = {int(years[a]): slice(int(a), int(b))
+                            for a, b in zip(starts, stops)}
+        names = df['continent'].cat.categories
+        codes = df['continent'].cat.codes.to_numpy()
+        starts = np.flatnonzero(np.r_[True, (years[1:] != years[:-1]) |
+                                      (codes[1:] != codes[:-1])])
+        stops = np.r_[starts[1:], len(years)]
+        self.continent_slices = {year: {} for year in self.year_slices}
+        for a, b in zip(starts, stops):
+            self.continent_slices[int(years[a])][names[codes[a]]] = slice(int(a), int(b))
+
+    @property
+    def years(self):
+        return sorted(self.year_slices)
+
+    def year(self, year):
+        """The rows of the table for a single year"""
+        try:
+            return self.df.iloc[self.year_slices[year]]
+        except KeyError:
+            raise ValueError("No data for year {}".format(year))
+
+    def continent(self, year, continent):
+        """The rows of the table for one continent in a single year"""
+        if year not in self.year_slices:
+            raise ValueError("No data for year {}".format(year))
+        rows = self.continent_slices[year].get(continent, slice(0, 0))
+        return self.df.iloc[rows]
+
+
+def _cache_path(source):
+    return os.path.splitext(source)[0] + '.npz'
+
+
+def _write_cache(df, cache, mtime):
+    arrays = {name: df[name].to_numpy() for name in NUMERIC_COLUMNS}
+    for name in CATEGORICAL_COLUMNS:
+        arrays[name + '_codes'] = df[name].cat.codes.to_numpy()
+        arrays[name + '_categories'] = np.asarray(df[name].cat.categories, dtype=str)
+    np.savez_compressed(cache, source_mtime=mtime, version=_CACHE_VERSION, **arrays)
+
+
+def _read_cache(cache, mtime):
+    """Read the cached table, or return None if it is missing or stale"""
+    try:
+        with np.load(cache) as npz:
+            if npz['version'] != _CACHE_VERSION or npz['source_mtime'] != mtime:
+                return None
+            columns = {}
+            for name in CATEGORICAL_COLUMNS:
+                columns[name] = pd.Categorical.from_codes(npz[name + '_codes'],
+                                                          npz[name + '_categories'])
+            for name in NUMERIC_COLUMNS:
+                columns[name] = npz[name]
+    except (IOError, KeyError, ValueError):
+        return None
+    return pd.DataFrame(columns)[list(COLUMNS)]
+
+
+def load_gapminder(source=DEFAULT_SOURCE, cache=None):
+    """
+    Load the gapminder dataset, using a cached columnar copy where possible.
+
+    Parameters
+    ----------
+    source: str, optional
+        Path to the tab-separated gapminder file
+    cache: str, optional
+        Path to the ``.npz`` cache. Defaults to the source path with a
+        ``.npz`` extension.
+
+    Returns
+    -------
+    data: `GapminderData`
+        The sorted table and its year and continent indices
+    """
+    if cache is None:
+        cache = _cache_path(source)
+    mtime = os.path.getmtime(source)
+    df = _read_cache(cache, mtime)
+    if df is None:
+        df = pd.read_csv(source, sep='\t',
+                         dtype=dict(country='category', continent='category'))
+        df = df.sort_values(['year', 'continent', 'country'], kind='mergesort')
+        df = df.reset_index(drop=True)
+        try:
+            _write_cache(df, cache, mtime)
+        except IOError:
+            # a read-only data directory just means we parse every time
+            pass
+    return GapminderData(df)
+
+
+def animate_rosling(data, interval=500, max_area=3500, axis=None):
+    """
+    Animated Rosling plot showing every year in turn.
+
+    A single scatter artist is used for all countries. Each frame only updates
+    its positions and sizes, and blitting means only that artist is redrawn.
+
+    Parameters
+    ----------
+    data: `GapminderData`
+        Dataset returned by `load_gapminder`
+    interval: int, optional
+        Delay between frames, in milliseconds
+    max_area: float, optional
+        Marker area, in points^2, of the most populous country
+    axis: `matplotlib.axes.Axes`, optional
+        Axes to draw on. A new figure is created if not given.
+
+    Returns
+    -------
+    anim: `matplotlib.animation.FuncAnimation`
+        The animation. Keep a reference to it for as long as it should run.
+    """
+    from matplotlib import pyplot as plt
+    from matplotlib.animation import FuncAnimation
+
+    if axis is None:
+        fig, axis = plt.subplots(figsize=(12, 10))
+    fig = axis.figure
+
+    df = data.df
+    gdp = df['gdpPercap'].to_numpy()
+    life = df['lifeExp'].to_numpy()
+    pop = df['pop'].to_numpy()
+    continents = df['continent']
+    colours = np.array([CONTINENT_COLOURS.get(name, 'grey')
+                        for name in continents.cat.categories])[continents.cat.codes]
+
+    years = data.years
+    first = data.year_slices[years[0]]
+    # sort order is the same every year, so colours only need setting once
+    scatter = axis.scatter(gdp[first], life[first], s=max_area*pop[first]/pop[first].max(),
+                           c=colours[first], alpha=0.7, animated=True)
+    label = axis.text(0.98, 0.02, str(years[0]), transform=axis.transAxes,
+                      ha='right', va='bottom', size=40, alpha=0.3, animated=True)
+
+    for name, colour in CONTINENT_COLOURS.items():
+        axis.scatter([], [], s=80, c=colour, alpha=0.7, label=name)
+    axis.legend(loc='upper left', scatterpoints=1, ncol=3)
+    axis.set_xscale('log')
+    axis.set_xlim(180, 100000)
+    axis.set_ylim(20, 90)
+    axis.set_xlabel('GDP per person')
+    axis.set_ylabel('Life Expectancy in Years')
+
+    def update(year):
+        rows = data.year_slices[year]
+        scatter.set_offsets(np.column_stack((gdp[rows], life[rows])))
+        scatter.set_sizes(max_area*pop[rows]/pop[rows].max())
+        label.set_text(str(year))
+        return scatter, label
+
+    return FuncAnimation(fig, update, frames=years, interval=interval, blit=True)
+
+
+if __name__ == "__main__":
+    from matplotlib import pyplot as plt
+    data = load_gapminder()
+    anim = animate_rosling(data)
+    plt.show()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""Build many pages with the id4glossary transform in a single Python process.
+
+Used as ``pandoc --filter=id4glossary.py``, every page starts a new Python
+interpreter just to add ids to the glossary. This script instead asks pandoc
+for each page's AST, applies the same transform in-process, and hands the
+result back to pandoc to write. Pages are built in parallel, and a page is
+skipped when neither its source, the pandoc options, the pandoc version nor
+the filter have changed since it was last built.
+
+Each page that is built still takes two pandoc processes, one to read it
+and one to write it, in place of one pandoc and one Python process. So a
+full rebuild is not much faster than running the filter; the time saved is
+in rebuilds where most pages are unchanged, and a rebuild with nothing to
+do only hashes the sources.
+
+Usage:
+
+    python glossary_batch.py lessons/ _site/ --jobs 8 --from markdown+smart -- --standalone --toc
+
+Everything after ``--`` is passed to pandoc when writing each page. Options
+for reading the sources are given with ``--from`` and ``--reader-arg``.
+"""
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pandocfilters as pf
+
+import id4glossary
+
+CACHE_FILE = '.glossary_cache.json'
+
+# options set by this script for each of the two pandoc calls, which would
+# silently override them if given again
+READER_OPTIONS = ('-f', '--from', '-r', '--read')
+WRITER_OPTIONS = ('-t', '--to', '-w', '--write', '-o', '--output')
+FORMAT_OPTIONS = READER_OPTIONS + WRITER_OPTIONS
+
+
+def find_sources(source_dir, pattern='*.md'):
+    """Paths, relative to source_dir, of every file matching pattern"""
+    found = []
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(fnmatch.filter(files, pattern)):
+            found.append(os.path.relpath(os.path.join(root, name), source_dir))
+    return found
+
+
+def _filter_digest():
+    """Hash of the filter code, so that changing it rebuilds every page"""
+    with open(id4glossary.__file__, 'rb') as fh:
+        return hashlib.sha256(fh.read()).hexdigest()
+
+
+def pandoc_version(pandoc='pandoc'):
+    """First line of ``pandoc --version``, or None if pandoc cannot be run"""
+    try:
+        result = subprocess.run([pandoc, '--version'], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.decode('utf-8', 'replace').split('\n')[0].strip()
+
+
+def _check_args(args, forbidden, where):
+    """Raise ValueError if any of args is one of the options in forbidden"""
+    for arg in args:
+        # long options may be given as --from=gfm, short ones as -fgfm
+        name = arg.split('=')[0] if arg.startswith('--') else arg[:2]
+        if name in forbidden:
+            raise ValueError("{} cannot be used in the {} arguments".format(arg, where))
+
+
+def page_digest(path, to, pandoc_args, filter_digest, reader_args=(), version=None):
+    """Hash of everything that determines the output of one page"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        digest.update(fh.read())
+    digest.update(json.dumps([to, list(pandoc_args), filter_digest,
+                              list(reader_args), version]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def apply_glossary(ast_json, to='html'):
+    """Apply the id4glossary transform to a pandoc JSON AST, returning JSON"""
+    return pf.applyJSONFilters([id4glossary.id4glossary], ast_json, to)
+
+
+def render(source, destination, to='html', pandoc='pandoc', pandoc_args=(), reader_args=()):
+    """
+    Convert one page with pandoc, applying the glossary transform in-process.
+
+    ``reader_args`` are passed to pandoc when reading the source, and
+    ``pandoc_args`` when writing the page. Raises `subprocess.CalledProcessError`
+    if pandoc fails.
+    """
+    _check_args(pandoc_args, FORMAT_OPTIONS, 'writer')
+    _check_args(reader_args, WRITER_OPTIONS, 'reader')
+    ast = subprocess.run([pandoc, source, '--to', 'json'] + list(reader_args),
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    filtered = apply_glossary(ast.stdout.decode('utf-8'), to)
+    dest_dir = os.path.dirname(destination)
+    if dest_dir and not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir, exist_ok=True)
+    subprocess.run([pandoc, '--from', 'json', '--to', to, '--output', destination] +
+                   list(pandoc_args),
+                   input=filtered.encode('utf-8'),
+                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+
+
+def _load_cache(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+
+def build(source_dir, output_dir, pattern='*.md', to='html', extension='.html',
+          jobs=None, force=False, pandoc='pandoc', pandoc_args=(), reader_args=()):
+    """
+    Build every matching page under source_dir into output_dir.
+
+    Parameters
+    ----------
+    source_dir, output_dir: str
+        Directories to read sources from and write pages to. The directory
+        structure of the sources is kept.
+    pattern: str, optional
+        Glob pattern selecting the source files
+    to: str, optional
+        Pandoc output format
+    extension: str, optional
+        File extension of the output pages
+    jobs: int, optional
+        Number of pages to build at once. Defaults to the number of CPUs.
+    force: bool, optional
+        Rebuild every page, even if it is unchanged
+    pandoc: str, optional
+        Name or path of the pandoc executable
+    pandoc_args: list, optional
+        Extra arguments for pandoc when writing each page. These cannot
+        include the input or output format or file, which are set here.
+    reader_args: list, optional
+        Extra arguments for pandoc when reading each source, e.g.
+        ``['--from', 'markdown+smart']``
+
+    Returns
+    -------
+    built, skipped: list
+        Relative paths of the pages that were rebuilt and skipped
+    failed: dict
+        Maps the relative path of each page that failed to pandoc's error message
+    """
+    _check_args(pandoc_args, FORMAT_OPTIONS, 'writer')
+    _check_args(reader_args, WRITER_OPTIONS, 'reader')
+    cache_path = os.path.join(output_dir, CACHE_FILE)
+    cache = {} if force else _load_cache(cache_path)
+    filter_digest = _filter_digest()
+    version = pandoc_version(pandoc)
+
+    todo = []
+    skipped = []
+    digests = {}
+    for rel in find_sources(source_dir, pattern):
+        src = os.path.join(source_dir, rel)
+        dest = os.path.join(output_dir, os.path.splitext(rel)[0] + extension)
+        digests[rel] = page_digest(src, to, pandoc_args, filter_digest, reader_args, version)
+        if cache.get(rel) == digests[rel] and os.path.exists(dest):
+            skipped.append(rel)
+        else:
+            todo.append((rel, src, dest))
+
+    def run(job):
+        rel, src, dest = job
+        try:
+            render(src, dest, to, pandoc, pandoc_args, reader_args)
+        except subprocess.CalledProcessError as err:
+            return rel, err.stderr.decode('utf-8', 'replace').strip()
+        except OSError as err:
+            # e.g. pandoc is not installed
+            return rel, str(err)
+        return rel, None
+
+    built = []
+    failed = {}
+    # pandoc does the heavy lifting in its own processes, so threads are enough
+    with ThreadPoolExecutor(jobs or os.cpu_count()) as pool:
+        for rel, error in pool.map(run, todo):
+            if error is None:
+                built.append(rel)
+                cache[rel] = digests[rel]
+            else:
+                failed[rel] = error
+                cache.pop(rel, None)
+
+    # forget pages whose sources have been removed
+    cache = {rel: digest for rel, digest in cache.items() if rel in digests}
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    with open(cache_path, 'w') as fh:
+        json.dump(cache, fh, indent=1, sort_keys=True)
+    return built, skipped, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                     epilog='Arguments after -- are passed to pandoc.')
+    parser.add_argument('source_dir', help='directory containing the lesson sources')
+    parser.add_argument('output_dir', help='directory to write the pages to')
+    parser.add_argument('--pattern', default='*.md', help='glob pattern for source files')
+    parser.add_argument('--to', default='html', help='pandoc output format')
+    parser.add_argument('--extension', default='.html', help='extension of output files')
+    parser.add_argument('--jobs', '-j', type=int, default=None, help='pages to build at once')
+    parser.add_argument('--force', action='store_true', help='rebuild unchanged pages')
+    parser.add_argument('--pandoc', default='pandoc', help='pandoc executable')
+    parser.add_argument('--from', '-f', dest='reader_format', default=None,
+                        help='pandoc input format of the sources, e.g. markdown+smart')
+    parser.add_argument('--reader-arg', action='append', default=[],
+                        help='extra pandoc option for reading the sources, '
+                             'e.g. --reader-arg=--tab-stop=2; may be repeated')
+    if argv is None:
+        argv = sys.argv[1:]
+    pandoc_args = []
+    if '--' in argv:
+        split = argv.index('--')
+        argv, pandoc_args = argv[:split], argv[split + 1:]
+    args = parser.parse_args(argv)
+    reader_args = list(args.reader_arg)
+    if args.reader_format is not None:
+        reader_args = ['--from', args.reader_format] + reader_args
+    try:
+        _check_args(pandoc_args, FORMAT_OPTIONS, 'writer')
+        _check_args(reader_args, WRITER_OPTIONS, 'reader')
+    except ValueError as err:
+        parser.error("{}; use --from, --to or --reader-arg instead".format(err))
+
+    built, skipped, failed = build(args.source_dir, args.output_dir, args.pattern, args.to,
+                                   args.extension, args.jobs, args.force, args.pandoc,
+                                   pandoc_args, reader_args)
+    for rel, error in sorted(failed.items()):
+        print("Failed to build {}:\n{}".format(rel, error), file=sys.stderr)
+    print("Built {} pages, {} unchanged, {} failed".format(len(built), len(skipped), len(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
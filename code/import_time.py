@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""Check that the course helper modules are quick to import.
+
+Each module is imported in a fresh interpreter with ``python -X importtime``,
+which reports how long every import took. The script fails if a module
+takes longer than its budget, or if importing it pulls in any of the slow
+packages (pyplot, photutils, ccdproc, ...) that should only be loaded by
+the functions that use them.
+
+Usage:
+
+    python import_time.py
+    python import_time.py --budget 150 --repeat 10 ../assignments/Session6/photometry_helpers.py
+
+The exit status is 1 if any module is over budget, so this can be run as a
+check before committing.
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# modules to check, and their import time budgets in milliseconds
+MODULES = {
+    os.path.join(ROOT, 'assignments', 'Session5', 'reduction_tools.py'): 250,
+    os.path.join(ROOT, 'assignments', 'Session6', 'photometry_helpers.py'): 250,
+}
+
+# packages that should never be imported just by importing a helper module
+HEAVY = ('matplotlib.pyplot', 'photutils', 'ccdproc', 'astropy.wcs', 'astropy.io.fits',
+         'astropy.table', 'astropy.visualization', 'scipy.spatial', 'scipy.ndimage', 'six')
+
+# "import time:  self [us] | cumulative | imported package", nested imports indented
+_LINE = re.compile(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)')
+
+
+def import_times(path, python=sys.executable):
+    """
+    Import times of a module and everything it imports, in a fresh interpreter.
+
+    Parameters
+    ----------
+    path: str
+        Path to the module's ``.py`` file
+    python: str, optional
+        Python interpreter to use
+
+    Returns
+    -------
+    times: dict
+        Cumulative import time in microseconds of each module imported,
+        keyed by module name
+    depth: dict
+        How deeply nested each import was; 1 for modules imported directly
+        by the module being checked
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    module = os.path.splitext(name)[0]
+    result = subprocess.run([python, '-X', 'importtime', '-c', 'import ' + module],
+                            cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError("Importing {} failed:\n{}".format(module, result.stderr))
+    times, depth = {}, {}
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            _, cumulative, indent, imported = match.groups()
+            times[imported] = int(cumulative)
+            depth[imported] = len(indent) // 2
+    return times, depth
+
+
+def check(path, budget, repeat=5, top=5, python=sys.executable):
+    """
+    Time the import of one module and print a report.
+
+    The module is imported ``repeat`` times, each in a new interpreter, and
+    the fastest time is used, so that disk caching and other noise do not
+    cause false alarms.
+
+    Returns
+    -------
+    ok: bool
+        True if the module imported within ``budget`` milliseconds without
+        importing any of the ``HEAVY`` packages
+    """
+    module = os.path.splitext(os.path.basename(path))[0]
+    runs = [import_times(path, python) for _ in range(repeat)]
+    times, depth = min(runs, key=lambda run: run[0][module])
+    total = times[module] / 1000
+    heavy = sorted(name for name in HEAVY if name in times)
+
+    ok = total <= budget and not heavy
+    print('{:<20s} {:7.1f} ms (budget {} ms) {}'.format(module, total, budget,
+                                                       'ok' if ok else 'FAIL'))
+    direct = sorted((name for name in times if depth[name] == 1),
+                    key=lambda name: times[name], reverse=True)
+    for name in direct[:top]:
+        print('    {:<30s} {:7.1f} ms'.format(name, times[name] / 1000))
+    if heavy:
+        print('    imported at load time: ' + ', '.join(heavy))
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('modules', nargs='*', help='paths of modules to check')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='import time budget in ms, overriding the defaults')
+    parser.add_argument('--repeat', type=int, default=5, help='imports to time per module')
+    parser.add_argument('--top', type=int, default=5, help='slowest direct imports to list')
+    args = parser.parse_args(argv)
+
+    modules = {path: MODULES.get(os.path.abspath(path), 250) for path in args.modules}
+    modules = modules or MODULES
+    results = [check(path, budget if args.budget is None else args.budget, args.repeat, args.top)
+               for path, budget in sorted(modules.items())]
+    return 0 if all(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,364 @@
+"""Periodograms for finding periodic signals in light curves.
+
+Two methods are provided, both of which take O(N log N) time rather than the
+O(N x Nfreq) of looping over trial frequencies:
+
+* evenly sampled data, like ``data/Session3/lightcurve.txt``, use the FFT
+  directly (`fft_periodogram`);
+* unevenly sampled data use the Lomb-Scargle periodogram from
+  `astropy.timeseries.LombScargle`, whose 'fast' method approximates the trig
+  sums by the method of Press & Rybicki (1989, ApJ, 338, 277), spreading the
+  data onto a regular grid and using an FFT (`lomb_scargle`).
+
+In both cases the power is normalised so that 1 means the sinusoid explains
+all of the variance, which makes `false_alarm_probability` applicable to
+either. Long frequency grids are evaluated in chunks of ``chunk`` frequencies,
+so memory use does not depend on the size of the grid.
+
+`periodogram` picks the method, and returns the strongest peaks with their
+false alarm probabilities; `batch_periodogram` runs it over many light
+curves in parallel.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+# maximum number of frequencies evaluated at once
+DEFAULT_CHUNK = 2**16
+
+PEAK_DTYPE = np.dtype([('frequency', 'f8'), ('period', 'f8'),
+                       ('power', 'f8'), ('fap', 'f8')])
+
+
+def is_evenly_sampled(t, rtol=1.0e-6):
+    """True if the times ``t`` are (to within ``rtol``) regularly spaced"""
+    dt = np.diff(t)
+    return len(dt) > 0 and np.allclose(dt, dt[0], rtol=rtol, atol=0)
+
+
+def frequency_grid(t, fmin=None, fmax=None, oversampling=5):
+    """
+    A regular grid of trial frequencies suited to a set of observation times.
+
+    Parameters
+    ----------
+    t: `np.ndarray`
+        Times of the observations
+    fmin: float, optional
+        Lowest frequency. Defaults to one cycle over the baseline.
+    fmax: float, optional
+        Highest frequency. Defaults to the (average) Nyquist frequency.
+    oversampling: float, optional
+        Number of grid points per independent frequency
+
+    Returns
+    -------
+    f0, df, nfreq: float, float, int
+        First frequency, spacing and number of frequencies
+    """
+    baseline = t.max() - t.min()
+    if fmin is None:
+        fmin = 1.0 / baseline
+    if fmax is None:
+        fmax = 0.5 * (len(t) - 1) / baseline
+    df = 1.0 / baseline / oversampling
+    nfreq = int(np.floor((fmax - fmin) / df)) + 1
+    return fmin, df, nfreq
+
+
+def fft_periodogram(t, y, fmin=None, fmax=None, oversampling=5):
+    """
+    Periodogram of evenly sampled data using the FFT.
+
+    The data are zero-padded by ``oversampling`` to give a finer frequency
+    grid than the natural 1/T spacing.
+
+    Parameters
+    ----------
+    t, y: `np.ndarray`
+        Evenly spaced times, and data values
+    fmin, fmax: float, optional
+        Frequency range to return. Defaults to 1/T up to the Nyquist frequency.
+    oversampling: int, optional
+        Zero-padding factor
+
+    Returns
+    -------
+    freq, power: `np.ndarray`
+        Frequencies and normalised power
+    """
+    if not is_evenly_sampled(t):
+        raise ValueError("FFT periodogram needs evenly sampled data; use lomb_scargle")
+    n = len(y)
+    dt = t[1] - t[0]
+    resid = y - y.mean()
+    nfft = int(2**np.ceil(np.log2(n * oversampling)))
+    power = np.abs(np.fft.rfft(resid, nfft))**2 * 2 / n / np.dot(resid, resid)
+    freq = np.fft.rfftfreq(nfft, dt)
+    if fmin is None:
+        fmin = 1.0 / (n * dt)
+    if fmax is None:
+        fmax = freq[-1]
+    keep = (freq >= fmin) & (freq <= fmax)
+    return freq[keep], power[keep]
+
+
+def lomb_scargle(t, y, dy=None, fmin=None, fmax=None, oversampling=5,
+                 fast=True, fit_mean=True, chunk=DEFAULT_CHUNK):
+    """
+    Lomb-Scargle periodogram of unevenly sampled data.
+
+    This evaluates `astropy.timeseries.LombScargle` on a regular frequency
+    grid, a chunk of frequencies at a time.
+
+    Parameters
+    ----------
+    t, y: `np.ndarray`
+        Times and data values
+    dy: `np.ndarray`, optional
+        Uncertainties on y. Points are weighted equally if not given.
+    fmin, fmax: float, optional
+        Frequency range. See `frequency_grid`.
+    oversampling: float, optional
+        Number of grid points per independent frequency
+    fast: bool, optional
+        Use the approximate O(N log N) method of Press & Rybicki. If False,
+        the periodogram is evaluated exactly, which is O(N x Nfreq).
+    fit_mean: bool, optional
+        Fit a constant offset at every frequency (the "floating mean"
+        periodogram), rather than just subtracting the mean of the data.
+    chunk: int, optional
+        Maximum number of frequencies to evaluate at once
+
+    Returns
+    -------
+    freq, power: `np.ndarray`
+        Frequencies and normalised power
+    """
+    from astropy.timeseries import LombScargle
+
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
+    model = LombScargle(t, y, dy, fit_mean=fit_mean, normalization='standard')
+    f0, df, nfreq = frequency_grid(t, fmin, fmax, oversampling)
+    freq = f0 + df * np.arange(nfreq)
+    power = np.empty(nfreq)
+    for start in range(0, nfreq, chunk):
+        block = slice(start, start + chunk)
+        if fast:
+            power[block] = model.power(freq[block], method='fast',
+                                       assume_regular_frequency=True)
+        else:
+            power[block] = model.power(freq[block], method='cython')
+    return freq, power
+
+
+def false_alarm_probability(power, ndata, nindependent):
+    """
+    Probability that noise alone would give a peak at least this high.
+
+    Uses the distribution of normalised periodogram power for Gaussian noise
+    at a single frequency, corrected for the number of independent
+    frequencies searched (e.g. Cumming et al. 1999, ApJ, 526, 890).
+
+    Parameters
+    ----------
+    power: float or `np.ndarray`
+        Normalised peak power(s)
+    ndata: int
+        Number of data points
+    nindependent: float
+        Number of independent frequencies searched, roughly the baseline
+        times the width of the frequency range
+
+    Returns
+    -------
+    fap: `np.ndarray`
+        The false alarm probability of each peak
+    """
+    power = np.clip(np.asarray(power, dtype=float), 0, 1)
+    single = (1 - power)**(0.5 * (ndata - 3))
+    # 1 - (1 - single)^M, written to keep precision when single is tiny
+    return -np.expm1(nindependent * np.log1p(-single))
+
+
+def top_peaks(freq, power, npeaks=3):
+    """Indices of the ``npeaks`` highest local maxima of a periodogram"""
+    interior = np.flatnonzero((power[1:-1] > power[:-2]) & (power[1:-1] >= power[2:])) + 1
+    order = np.argsort(power[interior])[::-1]
+    return interior[order[:npeaks]]
+
+
+def fit_sinusoids(t, y, frequencies, dy=None):
+    """
+    Least-squares fit of a constant plus a sinusoid at each of ``frequencies``.
+
+    Parameters
+    ----------
+    t, y: `np.ndarray`
+        Times and data values
+    frequencies: list
+        Frequencies of the sinusoids, which are fitted simultaneously
+    dy: `np.ndarray`, optional
+        Uncertainties on y
+
+    Returns
+    -------
+    model: `np.ndarray`
+        The best-fitting model at the times ``t``
+    """
+    phase = 2 * np.pi * np.outer(t, frequencies)
+    design = np.column_stack([np.ones_like(t), np.sin(phase), np.cos(phase)])
+    sqrt_w = np.ones_like(y) if dy is None else 1 / np.asarray(dy, dtype=float)
+    coeffs = np.linalg.lstsq(design * sqrt_w[:, None], y * sqrt_w, rcond=None)[0]
+    return np.dot(design, coeffs)
+
+
+def refine_frequency(t, y, frequency, width, dy=None, npoints=21, steps=3):
+    """
+    Locate a periodogram peak more precisely than the frequency grid.
+
+    The exact Lomb-Scargle power is evaluated on ``npoints`` frequencies
+    within ``width`` of ``frequency``, and the search is repeated ``steps``
+    times, each time around the best point and one grid step wide.
+    """
+    from astropy.timeseries import LombScargle
+
+    model = LombScargle(t, y, dy, normalization='standard')
+    for _ in range(steps):
+        df = 2 * width / (npoints - 1)
+        trial = frequency - width + df * np.arange(npoints)
+        frequency = trial[np.argmax(model.power(trial, method='cython'))]
+        width = df
+    return frequency
+
+
+def periodogram(t, y, dy=None, fmin=None, fmax=None, oversampling=5,
+                npeaks=3, method='auto', chunk=DEFAULT_CHUNK):
+    """
+    Periodogram of a light curve and its strongest peaks.
+
+    The peaks are found by prewhitening: after each peak is found, sinusoids
+    at all the peaks so far are fitted and subtracted from the data, and the
+    next peak is the highest in the periodogram of what is left. Taking the
+    highest local maxima of a single periodogram instead would report the
+    sidelobes of a strong peak as separate detections, and their false alarm
+    probabilities would be meaningless.
+
+    Parameters
+    ----------
+    t, y: `np.ndarray`
+        Times and data values
+    dy: `np.ndarray`, optional
+        Uncertainties on y. Only used by the Lomb-Scargle methods.
+    fmin, fmax: float, optional
+        Frequency range to search
+    oversampling: int, optional
+        Number of grid points per independent frequency
+    npeaks: int, optional
+        Number of peaks to report
+    method: str, optional
+        'fft', 'fast' (approximate Lomb-Scargle), 'direct' (exact
+        Lomb-Scargle) or 'auto', which uses the FFT for evenly sampled data
+        without uncertainties and 'fast' otherwise.
+    chunk: int, optional
+        Maximum number of frequencies to evaluate at once
+
+    Returns
+    -------
+    freq, power: `np.ndarray`
+        The periodogram of the original data
+    peaks: `np.ndarray`
+        Structured array with fields ``frequency``, ``period``, ``power``
+        and ``fap``, in the order found. ``power`` is the height of each peak
+        once the earlier peaks have been subtracted, and ``fap`` its false
+        alarm probability. Fewer than ``npeaks`` are returned if the
+        periodogram runs out of local maxima.
+    """
+    t = np.asarray(t, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if method == 'auto':
+        method = 'fft' if dy is None and is_evenly_sampled(t) else 'fast'
+    if method == 'fft':
+        search = partial(fft_periodogram, t, fmin=fmin, fmax=fmax, oversampling=oversampling)
+    elif method in ('fast', 'direct'):
+        search = partial(lomb_scargle, t, dy=dy, fmin=fmin, fmax=fmax,
+                         oversampling=oversampling, fast=(method == 'fast'), chunk=chunk)
+    else:
+        raise ValueError("Unknown method {}".format(method))
+
+    freq, power = search(y)
+    nindependent = max(1.0, (freq[-1] - freq[0]) * (t.max() - t.min()))
+    peaks = np.zeros(npeaks, dtype=PEAK_DTYPE)
+    resid, resid_power = y, power
+    for npeak in range(npeaks):
+        if npeak > 0:
+            resid = y - fit_sinusoids(t, y, peaks['frequency'][:npeak], dy)
+            resid_power = search(resid)[1]
+        idx = top_peaks(freq, resid_power, 1)
+        if len(idx) == 0:
+            peaks = peaks[:npeak]
+            break
+        # a frequency that is even a fraction of a grid step out leaves part
+        # of the sinusoid behind, to be found again as a spurious peak
+        peaks['frequency'][npeak] = refine_frequency(t, resid, freq[idx[0]],
+                                                     freq[1] - freq[0], dy)
+        peaks['power'][npeak] = resid_power[idx[0]]
+    peaks['period'] = 1 / peaks['frequency']
+    peaks['fap'] = false_alarm_probability(peaks['power'], len(t), nindependent)
+    return freq, power, peaks
+
+
+def _batch_worker(lightcurve, keep_power=False, **kwargs):
+    result = periodogram(*lightcurve, **kwargs)
+    return result if keep_power else result[2]
+
+
+def batch_periodogram(lightcurves, processes=None, keep_power=False, **kwargs):
+    """
+    Run `periodogram` over many light curves in parallel.
+
+    Parameters
+    ----------
+    lightcurves: iterable
+        Sequence of ``(t, y)`` or ``(t, y, dy)`` tuples
+    processes: int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+    keep_power: bool, optional
+        Return the full periodograms as well as the peaks. These can be
+        large, so by default only the peaks are sent back from the workers.
+
+    Other keyword arguments are passed to `periodogram`.
+
+    Returns
+    -------
+    results: list
+        For each light curve, the peaks table, or the ``(freq, power, peaks)``
+        tuple if ``keep_power`` is True.
+    """
+    worker = partial(_batch_worker, keep_power=keep_power, **kwargs)
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(worker, lightcurves))
+
+
+if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+    plt.style.use('bmh')
+
+    t, y = np.loadtxt('../data/Session3/lightcurve.txt', unpack=True)
+    freq, power, peaks = periodogram(t, y, fmax=2)
+    for peak in peaks:
+        print('P = {:.3f}, power = {:.3f}, FAP = {:.2g}'.format(
+            peak['period'], peak['power'], peak['fap']))
+
+    # the same data with 80% of points removed at random
+    keep = np.sort(np.random.choice(len(t), len(t) // 5, replace=False))
+    ufreq, upower, _ = periodogram(t[keep], y[keep], fmax=2)
+
+    plt.plot(freq, power, label='FFT')
+    plt.plot(ufreq, upower, label='Lomb-Scargle (uneven)')
+    plt.xlabel('Frequency')
+    plt.ylabel('Power')
+    plt.legend()
+    plt.show()
@@ -0,0 +1,293 @@
+# see http://spacemath.gsfc.nasa.gov/Calculus/10Page121.pdf
+"""Radiation dose accumulated by a spacecraft on an elliptical orbit.
+
+``spacecraft_radiation.py`` tabulates the dose rate at 20 angles around one
+orbit for students to integrate by hand. The functions here do the same
+calculation properly, for any number of orbits and for arrays of orbital
+parameters at once.
+
+The orbit is described by its eccentric anomaly theta. Time follows from
+Kepler's equation,
+
+    t = P (theta - e sin theta) / 2 pi,
+
+the distance from the Earth (in Earth radii) is
+
+    r = r0 - k / (c - d cos theta),
+
+and the dose rate is a sixth order polynomial in r. The defaults are the
+values used in the spacemath problem: a 9 hour orbit with e = 0.55.
+
+Note that ``spacecraft_radiation.py`` converts theta to degrees before using
+it in Kepler's equation; here theta is in radians throughout, so one orbit
+really does take P hours.
+
+All functions broadcast their arguments, so a set of parameter variations
+can be passed as arrays and evaluated in a single call.
+"""
+import numpy as np
+
+# dose rate polynomial coefficients, highest power first
+DOSE_COEFFS = (0.136, -2.194, 13.89, -43.73, 71.78, -57.95, 18.15)
+
+# number of times processed at once by cumulative_dose
+_CHUNK = 2**16
+
+
+def horner(coeffs, x):
+    """
+    Evaluate a polynomial with Horner's scheme.
+
+    Parameters
+    ----------
+    coeffs: sequence
+        Polynomial coefficients, highest power first
+    x: float or `np.ndarray`
+        Where to evaluate the polynomial
+
+    Returns
+    -------
+    value: `np.ndarray`
+        The polynomial evaluated at x
+    """
+    x = np.asarray(x, dtype=float)
+    result = np.full_like(x, coeffs[0])
+    for coeff in coeffs[1:]:
+        result *= x
+        result += coeff
+    return result
+
+
+def radius(theta, r0=5.7, k=210.0, c=100.0, d=55.0):
+    """Distance from the centre of the Earth, in Earth radii, at eccentric anomaly theta"""
+    return r0 - k / (c - d*np.cos(theta))
+
+
+def dose_rate(theta, coeffs=DOSE_COEFFS, **radius_kwargs):
+    """
+    Dose rate at eccentric anomaly theta.
+
+    Keyword arguments other than ``coeffs`` are passed to `radius`.
+    """
+    return horner(coeffs, radius(theta, **radius_kwargs))
+
+
+def time_from_angle(theta, period=9.0, ecc=0.55):
+    """Time since perigee at eccentric anomaly theta (Kepler's equation)"""
+    return period * (theta - ecc*np.sin(theta)) / 2 / np.pi
+
+
+def angle_from_time(t, period=9.0, ecc=0.55, tol=1.0e-12, max_iter=50):
+    """
+    Eccentric anomaly at time t, found by solving Kepler's equation.
+
+    Newton's method is applied to every element of ``t`` at once. Times
+    beyond the first orbit are handled, and the returned angle increases
+    by 2 pi every orbit.
+
+    Parameters
+    ----------
+    t: float or `np.ndarray`
+        Time since perigee
+    period, ecc: float or `np.ndarray`
+        Orbital period and eccentricity. Broadcast against t.
+    tol: float, optional
+        Convergence tolerance on theta, in radians
+    max_iter: int, optional
+        Maximum number of Newton iterations
+
+    Returns
+    -------
+    theta: `np.ndarray`
+        The eccentric anomaly, in radians
+    """
+    t, period, ecc = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (t, period, ecc)))
+    orbits, phase = np.divmod(t, period)
+    mean_anomaly = 2*np.pi*phase/period
+    # this starting guess converges for all e < 1 (Danby 1988)
+    theta = mean_anomaly + 0.85*ecc*np.sign(np.sin(mean_anomaly))
+    for _ in range(max_iter):
+        step = (theta - ecc*np.sin(theta) - mean_anomaly) / (1 - ecc*np.cos(theta))
+        theta = theta - step
+        if np.all(np.abs(step) < tol):
+            break
+    return theta + 2*np.pi*orbits
+
+
+def _dose_integrand(theta, period, ecc, coeffs, radius_kwargs):
+    """Dose rate times dt/dtheta, so that dose = integral of this over theta"""
+    dt_dtheta = period * (1 - ecc*np.cos(theta)) / 2 / np.pi
+    return dose_rate(theta, coeffs, **radius_kwargs) * dt_dtheta
+
+
+def orbit_dose(period=9.0, ecc=0.55, coeffs=DOSE_COEFFS, rtol=1.0e-10, **radius_kwargs):
+    """
+    Total dose received over one complete orbit.
+
+    The integrand is smooth and periodic, so the trapezium rule converges
+    very quickly. The number of points is doubled until every parameter set
+    has converged to ``rtol``.
+
+    Parameters
+    ----------
+    period, ecc: float or `np.ndarray`
+        Orbital period and eccentricity
+    coeffs: sequence, optional
+        Dose rate polynomial coefficients, highest power first
+    rtol: float, optional
+        Relative accuracy required
+
+    Other keyword arguments are passed to `radius`, and may also be arrays.
+
+    Returns
+    -------
+    dose: `np.ndarray`
+        Dose per orbit, for each set of parameters
+    """
+    params = np.broadcast_arrays(np.asarray(period, dtype=float), np.asarray(ecc, dtype=float),
+                                 *(np.asarray(v, dtype=float) for v in radius_kwargs.values()))
+    shape = params[0].shape
+    period, ecc = params[0][..., None], params[1][..., None]
+    rkw = {key: val[..., None] for key, val in zip(radius_kwargs, params[2:])}
+
+    npts = 16
+    theta = 2*np.pi*np.arange(npts)/npts
+    total = _dose_integrand(theta, period, ecc, coeffs, rkw).sum(axis=-1)
+    estimate = total * 2*np.pi/npts
+    while True:
+        # the new points fall midway between the old ones
+        theta = 2*np.pi*(np.arange(npts) + 0.5)/npts
+        total = total + _dose_integrand(theta, period, ecc, coeffs, rkw).sum(axis=-1)
+        npts *= 2
+        new_estimate = total * 2*np.pi/npts
+        if np.all(np.abs(new_estimate - estimate) <= rtol*np.abs(new_estimate)) or npts > 2**20:
+            return new_estimate.reshape(shape)
+        estimate = new_estimate
+
+
+def _interval_integrals(lo, width, period, ecc, coeffs, radius_kwargs, order=8):
+    """Integral of the dose integrand over [lo, lo + width] by Gauss-Legendre quadrature"""
+    nodes, weights = np.polynomial.legendre.leggauss(order)
+    theta = lo[..., None] + width/2 * (nodes + 1)
+    values = _dose_integrand(theta, period[..., None, None], ecc[..., None, None], coeffs,
+                             {key: val[..., None, None] for key, val in radius_kwargs.items()})
+    return width/2 * np.dot(values, weights)
+
+
+def _dose_table(period, ecc, coeffs, radius_kwargs, rtol):
+    """
+    Cumulative dose and dose integrand on a regular grid of eccentric anomaly over one orbit.
+
+    The arguments all have the same shape, and the tables have one extra
+    trailing axis. The grid is refined until cubic Hermite interpolation
+    between the grid points reproduces the cumulative dose at the interval
+    midpoints to ``rtol`` of the dose per orbit.
+    """
+    npts = 64
+    while True:
+        step = 2*np.pi/npts
+        theta = step*np.arange(npts + 1)
+        rate = _dose_integrand(theta, period[..., None], ecc[..., None], coeffs,
+                               {key: val[..., None] for key, val in radius_kwargs.items()})
+        pieces = _interval_integrals(theta[:-1], step, period, ecc, coeffs, radius_kwargs)
+        cumul = np.concatenate([np.zeros(pieces.shape[:-1] + (1,)),
+                                np.cumsum(pieces, axis=-1)], axis=-1)
+
+        # Hermite interpolation at s = 1/2 against direct integration
+        halves = _interval_integrals(theta[:-1], step/2, period, ecc, coeffs, radius_kwargs)
+        hermite = (cumul[..., :-1] + cumul[..., 1:])/2 + step*(rate[..., :-1] - rate[..., 1:])/8
+        error = np.abs(hermite - cumul[..., :-1] - halves).max(axis=-1)
+        if np.all(error <= rtol*np.abs(cumul[..., -1])) or npts >= 2**16:
+            return cumul, rate
+        npts *= 2
+
+
+def cumulative_dose(t, period=9.0, ecc=0.55, coeffs=DOSE_COEFFS, rtol=1.0e-10, **radius_kwargs):
+    """
+    Total dose received between perigee and time t.
+
+    The dose over one orbit is tabulated once for each set of parameters, on a
+    grid of eccentric anomaly that is refined until cubic Hermite interpolation
+    in the table reaches the requested accuracy. Each time then only needs
+    Kepler's equation solving and one table lookup, so millions of times can
+    be evaluated quickly, and the cost does not depend on how many orbits have
+    elapsed.
+
+    Parameters
+    ----------
+    t: float or `np.ndarray`
+        Time(s) since perigee, in the same units as ``period``
+    period, ecc: float or `np.ndarray`
+        Orbital period and eccentricity
+    coeffs: sequence, optional
+        Dose rate polynomial coefficients, highest power first
+    rtol: float, optional
+        Accuracy required, relative to the dose per orbit
+
+    Other keyword arguments are passed to `radius`. All array arguments are
+    broadcast against each other, so parameter studies can be done by giving
+    the parameters extra dimensions.
+
+    Returns
+    -------
+    dose: `np.ndarray`
+        The accumulated dose at each time
+    """
+    params = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in
+                                   [period, ecc] + list(radius_kwargs.values())))
+    table, rate = _dose_table(params[0], params[1], coeffs,
+                              dict(zip(radius_kwargs, params[2:])), rtol)
+    npts = table.shape[-1] - 1
+    table = table.reshape(-1, npts + 1)
+    rate = rate.reshape(-1, npts + 1)
+
+    # index of the parameter set used by each element of the output
+    t = np.asarray(t, dtype=float)
+    shape = np.broadcast_shapes(t.shape, params[0].shape)
+    which = np.broadcast_to(np.arange(table.shape[0]).reshape(params[0].shape), shape).ravel()
+    t = np.broadcast_to(t, shape).ravel()
+    period = np.broadcast_to(params[0], shape).ravel()
+    ecc = np.broadcast_to(params[1], shape).ravel()
+
+    dose = np.empty(len(t))
+    step = 2*np.pi/npts
+    # work through long arrays in chunks to bound the size of the temporaries
+    for start in range(0, len(t), _CHUNK):
+        part = slice(start, start + _CHUNK)
+        theta = angle_from_time(t[part], period[part], ecc[part])
+        orbits, theta = np.divmod(theta, 2*np.pi)
+        idx = np.minimum((theta / step).astype(int), npts - 1)
+        s = theta/step - idx
+        p = which[part]
+        y0, y1 = table[p, idx], table[p, idx + 1]
+        m0, m1 = step*rate[p, idx], step*rate[p, idx + 1]
+        # cubic Hermite basis functions
+        h00 = (1 + 2*s)*(1 - s)**2
+        h10 = s*(1 - s)**2
+        h01 = s**2*(3 - 2*s)
+        h11 = s**2*(s - 1)
+        dose[part] = orbits*table[p, -1] + h00*y0 + h10*m0 + h01*y1 + h11*m1
+    return dose.reshape(shape)
+
+if __name__ == "__main__":
+    import time
+    import matplotlib.pyplot as plt
+    plt.style.use('bmh')
+
+    # a one year mission, sampled every 30 seconds
+    t = np.linspace(0, 365.25*24, 365*24*120)
+    start = time.time()
+    dose = cumulative_dose(t)
+    print('{} samples in {:.2f} s'.format(len(t), time.time() - start))
+    print('dose per orbit = {:.4f}'.format(orbit_dose()))
+
+    # how does the dose per orbit depend on eccentricity?
+    ecc = np.linspace(0.3, 0.7, 200)
+    fig, axes = plt.subplots(ncols=2, figsize=(12, 5))
+    axes[0].plot(t[:2000], dose[:2000])
+    axes[0].set_xlabel('Time (hours)')
+    axes[0].set_ylabel('Cumulative dose')
+    axes[1].plot(ecc, orbit_dose(ecc=ecc))
+    axes[1].set_xlabel('Eccentricity')
+    axes[1].set_ylabel('Dose per orbit')
+    plt.show()
@@ -0,0 +1,340 @@
+"""Adaptive sampling of the Roche potential and its critical points.
+
+The Roche potential is written in the co-rotating frame of a binary with the
+primary star at the origin, the secondary at (1, 0, 0) and the orbital
+separation as the unit of length. This is the same convention used by
+``trm.roche.rpot``, so the functions here can be used in its place wherever
+arrays of positions need to be evaluated at once.
+
+Rather than sampling a uniform grid, `adaptive_contours` starts from a coarse
+grid and only refines the cells that a requested contour level passes through.
+Most of the plane is far from any contour, so this needs a small fraction of
+the potential evaluations of a uniform grid with the same resolution.
+"""
+import numpy as np
+
+# number of bisection steps used by the root finders. 60 halvings of the
+# starting bracket reaches double precision.
+_BISECT_STEPS = 60
+
+
+def rpot(q, x, y, z=0.0):
+    """
+    Roche potential at one or more positions.
+
+    Parameters
+    ----------
+    q: float or `np.ndarray`
+        Mass ratio, M2/M1
+    x, y, z: float or `np.ndarray`
+        Position(s) in units of the orbital separation. All arguments are
+        broadcast against each other.
+
+    Returns
+    -------
+    pot: `np.ndarray`
+        The Roche potential, in units of G(M1+M2)/a
+    """
+    q, x, y, z = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (q, x, y, z)))
+    mu = q / (1 + q)
+    x2y2 = x**2 + y**2
+    r1sq = x2y2 + z**2
+    with np.errstate(divide='ignore'):
+        r1 = np.sqrt(r1sq)
+        r2 = np.sqrt(r1sq + 1 - 2*x)
+        return -(1 - mu)/r1 - mu/r2 - (x2y2 + mu*(mu - 2*x))/2
+
+
+def _axis_force(x, q):
+    """x-derivative of the Roche potential along the line of centres"""
+    mu = q / (1 + q)
+    return (1 - mu)*np.sign(x)/x**2 + mu*np.sign(x - 1)/(x - 1)**2 - (x - mu)
+
+
+def _bisect(func, lo, hi):
+    """
+    Vectorised bisection for a root of func between lo and hi.
+
+    func must change sign across every bracket; lo and hi are arrays of the
+    same shape and each element is solved independently.
+    """
+    lo = np.array(lo, dtype=float)
+    hi = np.array(hi, dtype=float)
+    flo = np.sign(func(lo))
+    for _ in range(_BISECT_STEPS):
+        mid = 0.5*(lo + hi)
+        same = np.sign(func(mid)) == flo
+        lo = np.where(same, mid, lo)
+        hi = np.where(same, hi, mid)
+    return 0.5*(lo + hi)
+
+
+def lagrange_points(q):
+    """
+    Positions of the L1, L2 and L3 points for an array of mass ratios.
+
+    All three points lie on the line of centres, so only their x
+    coordinates are returned.
+
+    Parameters
+    ----------
+    q: float or `np.ndarray`
+        Mass ratio(s), M2/M1
+
+    Returns
+    -------
+    xl1, xl2, xl3: `np.ndarray`
+        x coordinate of each Lagrange point, in units of the orbital separation.
+        L1 lies between the stars, L2 beyond the secondary and L3 beyond the
+        primary.
+    """
+    q = np.atleast_1d(np.asarray(q, dtype=float))
+    if np.any(q <= 0):
+        raise ValueError("Mass ratios must be positive")
+    tiny = 1.0e-9
+    ones = np.ones_like(q)
+
+    def force(x):
+        return _axis_force(x, q)
+
+    # each point sits in a region where the force changes sign exactly once.
+    # L2 and L3 always lie within 2a of the stars.
+    xl1 = _bisect(force, tiny*ones, (1 - tiny)*ones)
+    xl2 = _bisect(force, (1 + tiny)*ones, 3*ones)
+    xl3 = _bisect(force, -2*ones, -tiny*ones)
+    return xl1, xl2, xl3
+
+
+def roche_lobe_radius(q, star=1, ntheta=24, nphi=24):
+    """
+    Volume-equivalent Roche lobe radius for an array of mass ratios.
+
+    The lobe surface is found along a set of rays from the centre of the star
+    by bisection, and the lobe volume is found by Gauss-Legendre quadrature
+    over the rays. All mass ratios and rays are solved together.
+
+    Parameters
+    ----------
+    q: float or `np.ndarray`
+        Mass ratio(s), M2/M1
+    star: int, optional
+        1 for the Roche lobe of the primary, 2 for the secondary
+    ntheta, nphi: int, optional
+        Number of quadrature points in polar angle and azimuth. The default
+        is accurate to better than 1 part in 10^4.
+
+    Returns
+    -------
+    radius: `np.ndarray`
+        Radius of the sphere with the same volume as the Roche lobe,
+        in units of the orbital separation.
+    """
+    if star not in (1, 2):
+        raise ValueError("star must be 1 or 2")
+    q = np.atleast_1d(np.asarray(q, dtype=float))
+    # the lobe of the secondary is the lobe of the primary of a binary with
+    # the roles of the stars swapped.
+    if star == 2:
+        q = 1/q
+    xl1, _, _ = lagrange_points(q)
+    pot_l1 = rpot(q, xl1, 0.0)
+
+    # the lobe is symmetric about the orbital plane, so only the upper
+    # hemisphere is needed. Axes are (q, theta, phi).
+    cost, wt = np.polynomial.legendre.leggauss(ntheta)
+    cost = 0.5*(cost + 1)
+    wt = 0.5*wt
+    phi = (np.arange(nphi) + 0.5) * 2*np.pi/nphi
+    sint = np.sqrt(1 - cost**2)
+    ux = (sint[:, None]*np.cos(phi))[None]
+    uy = (sint[:, None]*np.sin(phi))[None]
+    uz = np.broadcast_to(cost[:, None], ux.shape)
+    qq = q[:, None, None]
+    target = pot_l1[:, None, None]
+
+    def excess(r):
+        return rpot(qq, r*ux, r*uy, r*uz) - target
+
+    # the lobe lies entirely within a distance xl1 of the star
+    shape = (len(q), ntheta, nphi)
+    lo = np.full(shape, 1.0e-6)
+    hi = np.broadcast_to(xl1[:, None, None], shape)
+    r = _bisect(excess, lo, hi)
+
+    # V = 2 * int r^3/3 dOmega over the upper hemisphere
+    volume = 2*np.sum(r**3/3 * wt[None, :, None], axis=(1, 2)) * 2*np.pi/nphi
+    return np.cbrt(3*volume/4/np.pi)
+
+
+def _marching_squares(x0, y0, size, corners, level):
+    """
+    Line segments where ``level`` crosses a set of square cells.
+
+    corners has shape (ncell, 4), holding the potential at the
+    (x0, y0), (x0+size, y0), (x0+size, y0+size) and (x0, y0+size) corners.
+    Returns an array of shape (nseg, 2, 2).
+    """
+    cx = np.stack([x0, x0 + size, x0 + size, x0], axis=1)
+    cy = np.stack([y0, y0, y0 + size, y0 + size], axis=1)
+    above = corners > level
+    segments = []
+    # walk round the four edges, recording where the level is crossed
+    points = []
+    crosses = []
+    for i in range(4):
+        j = (i + 1) % 4
+        ci, cj = corners[:, i], corners[:, j]
+        cross = above[:, i] != above[:, j]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac = np.clip((level - ci) / (cj - ci), 0, 1)
+        frac = np.where(np.isfinite(frac), frac, 0.5)
+        px = cx[:, i] + frac*(cx[:, j] - cx[:, i])
+        py = cy[:, i] + frac*(cy[:, j] - cy[:, i])
+        points.append(np.stack([px, py], axis=1))
+        crosses.append(cross)
+    points = np.stack(points, axis=1)
+    crosses = np.stack(crosses, axis=1)
+    ncross = crosses.sum(axis=1)
+
+    # two crossings: a single segment joining them
+    two = ncross == 2
+    if np.any(two):
+        edge_idx = np.nonzero(crosses[two])[1].reshape(-1, 2)
+        pts = points[two]
+        rows = np.arange(len(pts))[:, None]
+        segments.append(pts[rows, edge_idx])
+
+    # four crossings is a saddle; pair the edges according to the cell centre
+    four = ncross == 4
+    if np.any(four):
+        pts = points[four]
+        centre_above = corners[four].mean(axis=1) > level
+        same = centre_above == above[four, 0]
+        # if the centre matches corner 0, corner 0 is connected to the centre
+        # and the contour cuts off corners 1 and 3; otherwise it cuts off 0 and 2
+        first = np.where(same[:, None], [0, 1], [1, 2])
+        second = np.where(same[:, None], [2, 3], [3, 0])
+        rows = np.arange(len(pts))[:, None]
+        segments.append(pts[rows, first])
+        segments.append(pts[rows, second])
+
+    if segments:
+        return np.concatenate(segments)
+    return np.empty((0, 2, 2))
+
+
+def adaptive_contours(q, levels, xlim=(-1, 2), ylim=(-1, 1),
+                      base=32, max_depth=5):
+    """
+    Contours of the Roche potential in the orbital plane, with adaptive refinement.
+
+    The region is first covered with a coarse grid of square cells. Any cell
+    whose corner values bracket one of the requested levels is split into
+    four, and the process repeats ``max_depth`` times. Contour segments are
+    then found by marching squares on the finest cells only.
+
+    Parameters
+    ----------
+    q: float
+        Mass ratio, M2/M1
+    levels: array-like
+        Potential values to contour
+    xlim, ylim: tuple, optional
+        Region to contour, in units of the orbital separation
+    base: int, optional
+        Number of cells across the shorter side of the coarse grid. Contour
+        loops smaller than one coarse cell may be missed.
+    max_depth: int, optional
+        Number of refinement levels. The final resolution matches a uniform
+        grid with ``base * 2**max_depth`` cells across the shorter side.
+
+    Returns
+    -------
+    segments: list of `np.ndarray`
+        One array of shape (nseg, 2, 2) per level, suitable for passing to
+        `matplotlib.collections.LineCollection`.
+    nevals: int
+        Total number of potential evaluations used.
+    """
+    levels = np.atleast_1d(np.asarray(levels, dtype=float))
+    size = min(xlim[1] - xlim[0], ylim[1] - ylim[0]) / base
+    nx = int(np.ceil((xlim[1] - xlim[0]) / size))
+    ny = int(np.ceil((ylim[1] - ylim[0]) / size))
+
+    # cells are stored by the integer index of their lower-left corner on the
+    # finest grid, so that shared corners can be evaluated only once.
+    scale = 2**max_depth
+    ix, iy = np.meshgrid(np.arange(nx)*scale, np.arange(ny)*scale)
+    ix, iy = ix.ravel(), iy.ravel()
+    step = scale
+    known_keys = np.empty(0, dtype=np.int64)
+    known_vals = np.empty(0)
+    nevals = 0
+    fine = size / scale
+    stride = ny*scale + 1
+    offsets = np.array([[0, 0], [1, 0], [1, 1], [0, 1]])
+
+    for depth in range(max_depth + 1):
+        cix = ix[:, None] + step*offsets[:, 0]
+        ciy = iy[:, None] + step*offsets[:, 1]
+        keys = cix.astype(np.int64)*stride + ciy
+        ukeys, inverse = np.unique(keys, return_inverse=True)
+        new = ~np.isin(ukeys, known_keys, assume_unique=True)
+        if np.any(new):
+            nk = ukeys[new]
+            vals = rpot(q, xlim[0] + (nk // stride)*fine, ylim[0] + (nk % stride)*fine)
+            nevals += len(nk)
+            known_keys = np.concatenate([known_keys, nk])
+            known_vals = np.concatenate([known_vals, vals])
+            order = np.argsort(known_keys)
+            known_keys, known_vals = known_keys[order], known_vals[order]
+        uvals = known_vals[np.searchsorted(known_keys, ukeys)]
+        corners = uvals[inverse.reshape(keys.shape)]
+
+        # the potential is -infinity at each star; clip so cells there compare sanely
+        corners = np.maximum(corners, levels.min() - 1)
+        lo = corners.min(axis=1)
+        hi = corners.max(axis=1)
+        active = np.any((lo[:, None] <= levels) & (hi[:, None] > levels), axis=1)
+        ix, iy, corners = ix[active], iy[active], corners[active]
+
+        if depth == max_depth:
+            break
+        # split every active cell into four children
+        step //= 2
+        ix = (ix[:, None] + step*offsets[:, 0]).ravel()
+        iy = (iy[:, None] + step*offsets[:, 1]).ravel()
+
+    x0 = xlim[0] + ix*fine
+    y0 = ylim[0] + iy*fine
+    segments = [_marching_squares(x0, y0, fine, corners, level) for level in levels]
+    return segments, nevals
+
+
+if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+    plt.style.use('bmh')
+
+    q = 0.3
+    xl1, xl2, xl3 = lagrange_points(q)
+    critical = rpot(q, np.concatenate([xl1, xl2, xl3]), 0.0)
+    levels = np.concatenate([np.linspace(-2.5, -1.6, 8), critical])
+    segments, nevals = adaptive_contours(q, levels)
+    print('{} potential evaluations (uniform grid would need {})'.format(
+        nevals, (32*2**5 + 1) * (48*2**5 + 1)))
+
+    fig, ax = plt.subplots()
+    for segs in segments:
+        ax.add_collection(LineCollection(segs, colors='k', linewidths=0.8))
+    ax.plot([xl1[0], xl2[0], xl3[0]], [0, 0, 0], 'r+')
+    ax.set_xlim(-1, 2)
+    ax.set_ylim(-1, 1)
+    ax.set_aspect('equal')
+
+    # Roche lobe radii for a range of mass ratios, compared with Eggleton (1983)
+    qs = np.logspace(-2, 2, 2000)
+    rl = roche_lobe_radius(qs, star=2)
+    eggleton = 0.49*qs**(2/3) / (0.6*qs**(2/3) + np.log(1 + qs**(1/3)))
+    print('max difference from Eggleton: {:.4f}'.format(np.abs(rl - eggleton).max()))
+    plt.show()
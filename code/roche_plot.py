@@ -1,8 +1,7 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits import mplot3d
-from trm import roche
-from trm.subs import Vec3
+from roche_grid import rpot
 
 plt.style.use('bmh')
 
@@ -10,10 +9,7 @@ x = np.linspace(-1,2,1000)
 y = np.linspace(-1,1,1000)
 X,Y = np.meshgrid(x,y)
 
-def f(x,y):
-    return roche.rpot(0.3,Vec3(x,y,0))
-fv = np.vectorize(f)
-Z = fv(X,Y)
+Z = rpot(0.3,X,Y)
 
 levels = np.linspace(0.0,-2.5,50)
 fig = plt.figure()
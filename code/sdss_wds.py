@@ -1,6 +1,7 @@
-from astroquery.vizier import Vizier
-catalog_list = Vizier.find_catalogs('J/ApJS/204/5')
-Vizier.ROW_LIMIT = -1
+import wd_catalog
 
-cata = Vizier.get_catalogs(catalog_list.keys())[0]
-print len(cata)
\ No newline at end of file
+# Reads the cached catalogue, building it from data/Session1/sdss_wds.csv the
+# first time. To refresh the cache from VizieR instead, use
+# cata = wd_catalog.fetch()
+cata = wd_catalog.open_catalog()
+print(len(cata))
@@ -0,0 +1,354 @@
+"""Offline, sky-partitioned cache of the SDSS DR7 white dwarf catalogue.
+
+The catalogue (Kleinman et al. 2013, VizieR J/ApJS/204/5) only needs to be
+downloaded once. `build_cache` stores it on disk with the rows sorted into
+cells on the sky: declination bands of fixed width, each split into right
+ascension cells of roughly equal area. Every column is written to its own
+``.npy`` file, and a small JSON index records where each cell starts and stops.
+
+`WDCatalog` memory-maps the column files, so a cone or box query only reads
+the rows in the cells that overlap the query region, and only the columns
+asked for. No network access is needed once the cache exists.
+
+The cache can be filled from the copy of the catalogue shipped with the
+course (``data/Session1/sdss_wds.csv``), from VizieR via astroquery, or from
+any URL serving the catalogue as CSV. `LocalCatalogServer` serves a CSV file
+over HTTP, as a stand-in for VizieR when testing the download path.
+"""
+import json
+import os
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.request import urlopen
+
+import numpy as np
+
+VIZIER_CATALOG = 'J/ApJS/204/5'
+
+DEFAULT_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'data', 'Session1', 'sdss_wds.csv')
+
+DEFAULT_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'data', 'Session1', 'sdss_wds_cache')
+
+# default height of the declination bands, in degrees
+DEFAULT_BAND = 2.0
+
+_INDEX_FILE = 'index.json'
+
+
+def _read_csv(source):
+    """Read a CSV catalogue from a path or file-like object into a structured array"""
+    table = np.genfromtxt(source, delimiter=',', names=True, dtype=None,
+                          encoding='utf-8', autostrip=True)
+    return np.atleast_1d(table)
+
+
+def _cell_layout(band):
+    """Number of RA cells in each declination band, giving cells of similar area"""
+    nband = int(np.ceil(180.0 / band))
+    lower = -90.0 + band*np.arange(nband)
+    # use the edge of the band closest to the equator, where cells are widest
+    widest = np.minimum(np.abs(lower), np.abs(lower + band))
+    widest = np.where(lower*(lower + band) < 0, 0.0, widest)
+    nra = np.maximum(1, np.floor(360.0*np.cos(np.radians(widest))/band)).astype(int)
+    return nra
+
+
+def _cell_ids(ra, dec, band, nra, first):
+    iband = np.clip(((np.asarray(dec) + 90.0)//band).astype(int), 0, len(nra) - 1)
+    ira = (np.mod(ra, 360.0) / 360.0 * nra[iband]).astype(int)
+    ira = np.minimum(ira, nra[iband] - 1)
+    return first[iband] + ira
+
+
+def build_cache(table, cache=DEFAULT_CACHE, band=DEFAULT_BAND,
+                ra_col='RAJ2000', dec_col='DEJ2000'):
+    """
+    Write a catalogue to a sky-partitioned on-disk cache.
+
+    Parameters
+    ----------
+    table: `np.ndarray` or `~astropy.table.Table`
+        The catalogue. Anything that can be indexed by column name works.
+    cache: str, optional
+        Directory to write the cache to. Created if it does not exist.
+    band: float, optional
+        Height of the declination bands, in degrees. Smaller bands make
+        small queries read fewer rows, at the cost of more cells.
+    ra_col, dec_col: str, optional
+        Names of the columns holding right ascension and declination, in degrees
+
+    Returns
+    -------
+    catalog: `WDCatalog`
+        The newly written catalogue
+    """
+    if hasattr(table, 'colnames'):
+        names = list(table.colnames)
+    else:
+        names = list(table.dtype.names)
+    ra = np.asarray(table[ra_col], dtype=float)
+    dec = np.asarray(table[dec_col], dtype=float)
+
+    nra = _cell_layout(band)
+    first = np.concatenate([[0], np.cumsum(nra)[:-1]])
+    cells = _cell_ids(ra, dec, band, nra, first)
+    order = np.argsort(cells, kind='mergesort')
+    counts = np.bincount(cells, minlength=int(nra.sum()))
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    if not os.path.isdir(cache):
+        os.makedirs(cache)
+    for name in names:
+        column = np.asarray(table[name])
+        if column.dtype.kind == 'O':
+            column = column.astype(str)
+        np.save(os.path.join(cache, name + '.npy'), column[order])
+
+    index = dict(band=band, nra=nra.tolist(), offsets=offsets.tolist(),
+                 columns=names, ra_col=ra_col, dec_col=dec_col)
+    # the index is written last, so a partial cache is never mistaken for a valid one
+    with open(os.path.join(cache, _INDEX_FILE), 'w') as fh:
+        json.dump(index, fh)
+    return WDCatalog(cache)
+
+
+def import_csv(source=DEFAULT_CSV, cache=DEFAULT_CACHE, **kwargs):
+    """
+    Build the cache from a CSV copy of the catalogue.
+
+    Parameters
+    ----------
+    source: str, optional
+        Path to the CSV file. Defaults to the copy shipped in ``data/Session1``.
+    cache: str, optional
+        Directory to write the cache to
+
+    Other keyword arguments are passed to `build_cache`.
+    """
+    return build_cache(_read_csv(source), cache, **kwargs)
+
+
+def fetch(url=None, cache=DEFAULT_CACHE, timeout=60, **kwargs):
+    """
+    Download the full catalogue once and build the cache from it.
+
+    Parameters
+    ----------
+    url: str, optional
+        URL returning the catalogue as CSV with a header row. If not given,
+        the catalogue is downloaded from VizieR with astroquery.
+    cache: str, optional
+        Directory to write the cache to
+    timeout: float, optional
+        Network timeout, in seconds
+
+    Other keyword arguments are passed to `build_cache`.
+    """
+    if url is not None:
+        with urlopen(url, timeout=timeout) as response:
+            text = response.read().decode('utf-8')
+        return build_cache(_read_csv(text.splitlines()), cache, **kwargs)
+
+    from astroquery.vizier import Vizier
+    vizier = Vizier(row_limit=-1, timeout=timeout)
+    table = vizier.get_catalogs(VIZIER_CATALOG)[0]
+    return build_cache(table, cache, **kwargs)
+
+
+def open_catalog(cache=DEFAULT_CACHE, source=DEFAULT_CSV):
+    """
+    Open the cached catalogue, building it from the shipped CSV if necessary.
+
+    This never touches the network.
+    """
+    if not os.path.exists(os.path.join(cache, _INDEX_FILE)):
+        return import_csv(source, cache)
+    return WDCatalog(cache)
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """Angular separation in degrees between points given in degrees (haversine formula)"""
+    ra1, dec1, ra2, dec2 = (np.radians(v) for v in (ra1, dec1, ra2, dec2))
+    hav = (np.sin((dec2 - dec1)/2)**2 +
+           np.cos(dec1)*np.cos(dec2)*np.sin((ra2 - ra1)/2)**2)
+    return np.degrees(2*np.arcsin(np.sqrt(np.clip(hav, 0, 1))))
+
+
+class WDCatalog:
+    """
+    Region queries against a sky-partitioned catalogue cache.
+
+    Parameters
+    ----------
+    cache: str
+        Directory written by `build_cache`
+    """
+    def __init__(self, cache=DEFAULT_CACHE):
+        self.cache = cache
+        with open(os.path.join(cache, _INDEX_FILE)) as fh:
+            index = json.load(fh)
+        self.band = index['band']
+        self.nra = np.array(index['nra'])
+        self.first = np.concatenate([[0], np.cumsum(self.nra)[:-1]])
+        self.offsets = np.array(index['offsets'])
+        self.columns = index['columns']
+        self.ra_col = index['ra_col']
+        self.dec_col = index['dec_col']
+        self._columns = {}
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def column(self, name):
+        """Memory-mapped array holding one column of the whole catalogue"""
+        if name not in self.columns:
+            raise KeyError("No column {} in catalogue; choose from {}".format(name, self.columns))
+        try:
+            return self._columns[name]
+        except KeyError:
+            self._columns[name] = np.load(os.path.join(self.cache, name + '.npy'),
+                                          mmap_mode='r')
+            return self._columns[name]
+
+    def _bands(self, dec_min, dec_max):
+        lo = int(np.clip((dec_min + 90.0)//self.band, 0, len(self.nra) - 1))
+        hi = int(np.clip((dec_max + 90.0)//self.band, 0, len(self.nra) - 1))
+        return range(lo, hi + 1)
+
+    def _cells_in_ra(self, iband, ra_min, ra_max):
+        """Cells of one band overlapping ra_min..ra_max, which may wrap through 0"""
+        n = self.nra[iband]
+        if ra_max - ra_min >= 360.0:
+            return np.arange(n) + self.first[iband]
+        start = np.mod(ra_min, 360.0)
+        lo = int(np.floor(start / 360.0 * n))
+        hi = int(np.floor((start + ra_max - ra_min) / 360.0 * n))
+        return np.mod(np.arange(lo, min(hi, lo + n - 1) + 1), n) + self.first[iband]
+
+    def _rows(self, cells):
+        """Row indices covered by a set of cells, as an array"""
+        cells = np.unique(cells)
+        starts, stops = self.offsets[cells], self.offsets[cells + 1]
+        keep = stops > starts
+        if not np.any(keep):
+            return np.empty(0, dtype=int)
+        return np.concatenate([np.arange(a, b) for a, b in zip(starts[keep], stops[keep])])
+
+    def _select(self, rows, columns):
+        if columns is None:
+            columns = self.columns
+        elif isinstance(columns, str):
+            columns = [columns]
+        return {name: np.asarray(self.column(name)[rows]) for name in columns}
+
+    def cone(self, ra, dec, radius, columns=None):
+        """
+        All objects within ``radius`` degrees of a position.
+
+        Parameters
+        ----------
+        ra, dec: float
+            Centre of the cone, in degrees
+        radius: float
+            Radius of the cone, in degrees
+        columns: list of str, optional
+            Columns to return. All columns are returned if not given.
+
+        Returns
+        -------
+        result: dict
+            Maps each requested column name to an array of values
+        """
+        # widest extent of the cone in RA; the cone covers every RA if it contains a pole
+        if abs(dec) + radius >= 90.0:
+            half = 180.0
+        else:
+            half = np.degrees(np.arcsin(np.sin(np.radians(radius)) / np.cos(np.radians(dec))))
+        cells = [self._cells_in_ra(iband, ra - half, ra + half)
+                 for iband in self._bands(dec - radius, dec + radius)]
+        rows = self._rows(np.concatenate(cells))
+        sep = angular_separation(ra, dec, self.column(self.ra_col)[rows],
+                                 self.column(self.dec_col)[rows])
+        return self._select(rows[sep <= radius], columns)
+
+    def box(self, ra_min, ra_max, dec_min, dec_max, columns=None):
+        """
+        All objects within a range of right ascension and declination.
+
+        If ``ra_min > ra_max`` the box is taken to wrap through RA = 0.
+
+        Parameters
+        ----------
+        ra_min, ra_max: float
+            Limits in right ascension, in degrees
+        dec_min, dec_max: float
+            Limits in declination, in degrees
+        columns: list of str, optional
+            Columns to return. All columns are returned if not given.
+
+        Returns
+        -------
+        result: dict
+            Maps each requested column name to an array of values
+        """
+        span = ra_max - ra_min if ra_max >= ra_min else ra_max + 360.0 - ra_min
+        cells = [self._cells_in_ra(iband, ra_min, ra_min + span)
+                 for iband in self._bands(dec_min, dec_max)]
+        rows = self._rows(np.concatenate(cells))
+        ra = np.asarray(self.column(self.ra_col)[rows])
+        dec = np.asarray(self.column(self.dec_col)[rows])
+        inside = (np.mod(ra - ra_min, 360.0) <= span) & (dec >= dec_min) & (dec <= dec_max)
+        return self._select(rows[inside], columns)
+
+
+class LocalCatalogServer:
+    """
+    Serve a CSV catalogue over HTTP on localhost, as a stand-in for VizieR.
+
+    Every GET request returns the whole file, whatever the path. Use it as a
+    context manager; the ``url`` attribute can be passed to `fetch`::
+
+        with LocalCatalogServer(DEFAULT_CSV) as server:
+            catalog = fetch(server.url, cache='/tmp/wd_cache')
+    """
+    def __init__(self, source=DEFAULT_CSV, port=0):
+        with open(source, 'rb') as fh:
+            payload = fh.read()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/csv')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = HTTPServer(('127.0.0.1', port), Handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://{}:{}/viz-bin/asu-csv?-source={}'.format(host, port, VIZIER_CATALOG)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+if __name__ == "__main__":
+    catalog = open_catalog()
+    print(len(catalog))
+    near = catalog.cone(180.0, 30.0, 5.0, columns=['RAJ2000', 'DEJ2000', 'Teff'])
+    print('{} white dwarfs within 5 degrees of (180, +30)'.format(len(near['Teff'])))